@@ -0,0 +1,130 @@
+"""Per-route-group admission control.
+
+Expensive routes are grouped, and each group admits a bounded number of concurrent requests. Further
+requests wait in a bounded FIFO queue for a bounded time; past either bound they are shed at once
+with 429 (queue full) or 503 (waited too long) and a `Retry-After` estimate, instead of piling up in
+the threadpool in front of the cheap routes.
+"""
+import asyncio
+import math
+import time
+from collections import Counter, deque
+
+from fastapi import HTTPException
+
+from config import ADMISSION_LIMITS
+
+
+class AdmissionRejected(RuntimeError):
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RouteGroupLimiter:
+    """Concurrency limit with a bounded wait queue; used only from the event loop, so it needs no lock."""
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, max_wait_ms: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait_ms / 1000
+        self.active = 0
+        self.admitted = 0
+        self.shed = Counter()
+        # Moving average of how long admitted requests hold their slot, for Retry-After.
+        self.service_seconds = 0.0
+        self._waiters = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """Seconds until the queue ahead of a new request has likely drained, between 1 and 60."""
+        estimate = self.service_seconds * (self.queued + 1) / max(self.max_concurrency, 1)
+        return min(60, max(1, math.ceil(estimate)))
+
+    def _reject(self, reason: str, message: str, status_code: int):
+        self.shed[reason] += 1
+        raise AdmissionRejected(message, status_code, self.retry_after())
+
+    async def acquire(self):
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+        if self.queued >= self.max_queue:
+            self._reject("queue_full", f"Too many concurrent {self.name} requests, try again later", 429)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except asyncio.TimeoutError:
+            self._reject("timeout", f"Server too busy to handle {self.name} requests, try again later", 503)
+        except asyncio.CancelledError:
+            # The client went away; if a slot was handed over in the meantime, pass it on.
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+        self.admitted += 1
+
+    def release(self, seconds: float = None):
+        if seconds is not None:
+            self.service_seconds += 0.2 * (seconds - self.service_seconds)
+        # Hand the slot straight to the oldest waiter, so a new arrival cannot overtake the queue.
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class AdmissionController:
+    def __init__(self, limits=ADMISSION_LIMITS):
+        self.limiters = {group: RouteGroupLimiter(group, *group_limits) for group, group_limits in limits.items()}
+
+    def limit(self, group: str):
+        """FastAPI dependency holding a slot of `group` until the response has been sent."""
+
+        async def dependency():
+            limiter = self.limiters.get(group)
+            if limiter is None:
+                yield
+                return
+            try:
+                await limiter.acquire()
+            except AdmissionRejected as e:
+                raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+            started = time.perf_counter()
+            try:
+                yield
+            finally:
+                limiter.release(time.perf_counter() - started)
+
+        return dependency
+
+    def collect(self):
+        """Metric families for `Metrics.add_collector`."""
+        limiters = sorted(self.limiters.items())
+        return [
+            ("admission_active_requests", "gauge", "Requests of the route group currently being served.",
+             [({"group": group}, limiter.active) for group, limiter in limiters]),
+            ("admission_queue_depth", "gauge", "Requests of the route group waiting for a slot.",
+             [({"group": group}, limiter.queued) for group, limiter in limiters]),
+            ("admission_admitted_total", "counter", "Requests of the route group admitted.",
+             [({"group": group}, limiter.admitted) for group, limiter in limiters]),
+            ("admission_shed_total", "counter", "Requests of the route group rejected because its queue was full or they waited too long.",
+             [({"group": group, "reason": reason}, limiter.shed[reason]) for group, limiter in limiters for reason in ("queue_full", "timeout")]),
+        ]
+
+
+admission_controller = AdmissionController()
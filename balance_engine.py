@@ -0,0 +1,59 @@
+"""Engines that compute a balance matrix from (payer, splitter, share) split rows.
+
+Both engines return the same {participant: {other: amount}} shape as `crud.calculate_balance`.
+"""
+from config import BALANCE_NUMPY_THRESHOLD
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; the pure-Python engine is always available.
+    np = None
+
+
+class EngineUnavailableError(RuntimeError):
+    pass
+
+
+def _all_names(participants, payers, splitters):
+    # Names outside the participant list can only come from rows stored before splits were validated.
+    names = list(participants)
+    names.extend(sorted((set(payers) | set(splitters)) - set(names)))
+    return names
+
+
+def compute_balance_python(participants, payers, splitters, shares):
+    names = _all_names(participants, payers, splitters)
+    balance_record = {p: {other: 0.0 for other in names} for p in names}
+    for payer, splitter, share in zip(payers, splitters, shares):
+        if payer != splitter:
+            balance_record[payer][splitter] += share
+            balance_record[splitter][payer] -= share
+    return balance_record
+
+
+def compute_balance_numpy(participants, payers, splitters, shares):
+    if np is None:
+        raise EngineUnavailableError("NumPy is not installed")
+    names = _all_names(participants, payers, splitters)
+    index = {name: i for i, name in enumerate(names)}
+    n = len(names)
+
+    payer_idx = np.fromiter(map(index.__getitem__, payers), dtype=np.intp, count=len(payers))
+    splitter_idx = np.fromiter(map(index.__getitem__, splitters), dtype=np.intp, count=len(splitters))
+    weights = np.asarray(shares, dtype=np.float64)
+    mask = payer_idx != splitter_idx
+    # owed[p, s] is what s owes p; every share is scatter-added into its flattened cell in one pass.
+    # bincount returns int64 when no weights are selected, so cast to keep the amounts floats.
+    owed = np.bincount(
+        payer_idx[mask] * n + splitter_idx[mask], weights=weights[mask], minlength=n * n
+    ).astype(np.float64, copy=False).reshape(n, n)
+    matrix = owed - owed.T
+    return {name: dict(zip(names, row)) for name, row in zip(names, matrix.tolist())}
+
+
+def compute_balance(participants, payers, splitters, shares, engine: str = "auto"):
+    if engine == "auto":
+        engine = "numpy" if np is not None and len(shares) >= BALANCE_NUMPY_THRESHOLD else "python"
+    if engine == "numpy":
+        return compute_balance_numpy(participants, payers, splitters, shares)
+    return compute_balance_python(participants, payers, splitters, shares)
@@ -0,0 +1,140 @@
+"""In-process fan-out of balance updates to Server-Sent Events subscribers.
+
+Write routes call `BalanceBroker.publish` after committing. The broker waits `coalesce_ms` so a burst
+of writes to one bill list costs a single balance read, then hands the new snapshot to every
+subscriber of that list. Each subscriber buffers at most `buffer_size` snapshots; when a slow client
+falls behind, the oldest are dropped, which loses nothing because every snapshot is complete.
+"""
+import asyncio
+from collections import deque
+
+from fastapi.concurrency import run_in_threadpool
+
+import crud
+import serialization
+from config import BALANCE_STREAM_BUFFER, BALANCE_STREAM_COALESCE_MS, BALANCE_STREAM_KEEPALIVE_S
+
+# Queued in place of a snapshot when the broker shuts down.
+CLOSED = object()
+
+
+class BalanceSubscription:
+    def __init__(self, bill_list_id: int, buffer_size: int):
+        self.bill_list_id = bill_list_id
+        self.version = None
+        self.dropped = 0
+        self._snapshots = deque(maxlen=buffer_size)
+        self._ready = asyncio.Event()
+
+    def put(self, snapshot):
+        """Queue a (version, balance) snapshot, None for a deleted list, or CLOSED."""
+        if isinstance(snapshot, tuple):
+            # Flushes can finish out of order; never send a client an older version than it has seen.
+            if self.version is not None and snapshot[0] <= self.version:
+                return
+            self.version = snapshot[0]
+        if len(self._snapshots) == self._snapshots.maxlen:
+            self.dropped += 1
+        self._snapshots.append(snapshot)
+        self._ready.set()
+
+    async def get(self, timeout: float):
+        """Next queued snapshot, or raise asyncio.TimeoutError if none arrives within `timeout` seconds."""
+        if not self._snapshots:
+            self._ready.clear()
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        return self._snapshots.popleft()
+
+
+def _load_snapshot(session_factory, bill_list_id: int):
+    db = session_factory()
+    try:
+        return crud.get_balance_snapshot(db, bill_list_id)
+    finally:
+        db.close()
+
+
+class BalanceBroker:
+    def __init__(self, coalesce_ms: int = BALANCE_STREAM_COALESCE_MS, buffer_size: int = BALANCE_STREAM_BUFFER):
+        self.coalesce = coalesce_ms / 1000
+        self.buffer_size = buffer_size
+        self.flushes = 0
+        self.coalesced = 0
+        self._subscribers = {}
+        self._flushers = {}
+
+    def subscribe(self, bill_list_id: int) -> BalanceSubscription:
+        subscription = BalanceSubscription(bill_list_id, self.buffer_size)
+        self._subscribers.setdefault(bill_list_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: BalanceSubscription):
+        subscribers = self._subscribers.get(subscription.bill_list_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.bill_list_id]
+
+    def subscriber_count(self, bill_list_id: int = None) -> int:
+        if bill_list_id is not None:
+            return len(self._subscribers.get(bill_list_id, ()))
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def publish(self, bill_list_id: int, session_factory):
+        """Note that `bill_list_id` changed; must be called from the event loop after the write commits."""
+        if bill_list_id not in self._subscribers:
+            return
+        if bill_list_id in self._flushers:
+            self.coalesced += 1
+            return
+        self._flushers[bill_list_id] = asyncio.get_running_loop().create_task(self._flush(bill_list_id, session_factory))
+
+    async def _flush(self, bill_list_id: int, session_factory):
+        try:
+            await asyncio.sleep(self.coalesce)
+        finally:
+            # Writes published from here on schedule a new flush instead of joining this one.
+            del self._flushers[bill_list_id]
+        snapshot = await run_in_threadpool(_load_snapshot, session_factory, bill_list_id)
+        self.flushes += 1
+        for subscription in list(self._subscribers.get(bill_list_id, ())):
+            subscription.put(snapshot)
+
+    def close(self):
+        """End every open stream, e.g. so server shutdown is not held up by connected clients."""
+        for flusher in list(self._flushers.values()):
+            flusher.cancel()
+        for subscribers in self._subscribers.values():
+            for subscription in subscribers:
+                subscription.put(CLOSED)
+
+
+def _balance_event(snapshot, sparse: bool) -> bytes:
+    version, balance = snapshot
+    if sparse:
+        balance = crud.sparse_balance(balance)
+    return b"id: %d\nevent: balance\ndata: %s\n\n" % (version, serialization.dumps(balance))
+
+
+async def iter_balance_events(broker: BalanceBroker, subscription: BalanceSubscription, sparse: bool = False,
+                              keepalive_s: float = BALANCE_STREAM_KEEPALIVE_S):
+    """Encode a subscription as an SSE stream, ending when the bill list is deleted or the broker closes.
+
+    The event id is the bill list version, the same number the balance endpoint's ETag is built from.
+    """
+    try:
+        while True:
+            try:
+                snapshot = await subscription.get(keepalive_s)
+            except asyncio.TimeoutError:
+                # Comments keep proxies from closing an idle connection.
+                yield b": keepalive\n\n"
+                continue
+            if snapshot is CLOSED:
+                return
+            if snapshot is None:
+                yield b"event: deleted\ndata: {}\n\n"
+                return
+            yield _balance_event(snapshot, sparse)
+    finally:
+        broker.unsubscribe(subscription)
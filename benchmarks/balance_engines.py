@@ -0,0 +1,53 @@
+"""Compare the Python and NumPy balance engines on synthetic split rows.
+
+    python -m benchmarks.balance_engines --participants 200 --transactions 100000
+"""
+import argparse
+import random
+import time
+
+import balance_engine
+
+
+def synthetic_splits(participants: int, transactions: int, max_splitters: int = 5, seed: int = 0):
+    rng = random.Random(seed)
+    names = [f"participant{i}" for i in range(participants)]
+    payers, splitters, shares = [], [], []
+    for _ in range(transactions):
+        payer = rng.choice(names)
+        group = rng.sample(names, rng.randint(1, min(max_splitters, participants)))
+        amount = round(rng.uniform(1, 500), 2)
+        for splitter in group:
+            payers.append(payer)
+            splitters.append(splitter)
+            shares.append(amount / len(group))
+    return names, payers, splitters, shares
+
+
+def best_time(fn, *args, repeat: int = 3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--participants", type=int, default=200)
+    parser.add_argument("--transactions", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    rows = synthetic_splits(args.participants, args.transactions)
+    python_seconds = best_time(balance_engine.compute_balance_python, *rows, repeat=args.repeat)
+    numpy_seconds = best_time(balance_engine.compute_balance_numpy, *rows, repeat=args.repeat)
+    print(f"{args.participants} participants, {args.transactions} transactions, {len(rows[3])} split rows")
+    print(f"python: {python_seconds * 1000:.1f} ms")
+    print(f"numpy:  {numpy_seconds * 1000:.1f} ms")
+    print(f"speedup: {python_seconds / numpy_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Measure transaction insert throughput under concurrent writers, with and without group commit.
+
+    python -m benchmarks.group_commit --writers 32 --inserts 50
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import crud
+import schemas
+from database import configure_engine
+from group_commit import GroupCommitWriter
+from models import Base
+
+TRANSACTION = schemas.TransactionCreate(amount=30.0, whatfor="benchmark", payer="participant0", split_between="participant0, participant1, participant2")
+
+
+def _session_factory(path):
+    engine = configure_engine(create_engine(f"sqlite:///{path}", pool_size=64, max_overflow=0))
+    Base.metadata.create_all(bind=engine)
+    return engine, sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def _run_writers(writers: int, inserts: int, insert_one):
+    errors = []
+
+    def work():
+        for _ in range(inserts):
+            try:
+                insert_one()
+            except Exception as e:  # Counted and reported rather than aborting the run.
+                errors.append(e)
+
+    threads = [threading.Thread(target=work) for _ in range(writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, len(errors)
+
+
+def measure(mode: str, writers: int, inserts: int):
+    with tempfile.TemporaryDirectory() as directory:
+        engine, SessionLocal = _session_factory(os.path.join(directory, "bench.db"))
+        db = SessionLocal()
+        bill_list = crud.create_bill_list(db, schemas.BillListCreate(
+            title="benchmark", participants=[schemas.ParticipantCreate(name=f"participant{i}") for i in range(3)]
+        ))
+        bill_list_id = bill_list.id
+        db.close()
+
+        if mode == "group":
+            writer = GroupCommitWriter(SessionLocal)
+
+            def insert_one():
+                writer.submit(bill_list_id, TRANSACTION).result()
+        else:
+            writer = None
+
+            def insert_one():
+                session = SessionLocal()
+                try:
+                    crud.create_transaction(session, bill_list_id, TRANSACTION)
+                finally:
+                    session.close()
+
+        seconds, errors = _run_writers(writers, inserts, insert_one)
+        if writer is not None:
+            writer.close()
+        engine.dispose()
+    rows = writers * inserts - errors
+    return {"mode": mode, "rows": rows, "errors": errors, "seconds": seconds, "rows_per_second": rows / seconds,
+            "commits": writer.batches if writer is not None else rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", type=int, default=32)
+    parser.add_argument("--inserts", type=int, default=50, help="Inserts per writer thread")
+    args = parser.parse_args(argv)
+
+    direct = measure("direct", args.writers, args.inserts)
+    group = measure("group", args.writers, args.inserts)
+    for result in (direct, group):
+        print(f"{result['mode']:>6}: {result['rows_per_second']:8.0f} rows/s, {result['commits']} commits, {result['errors']} errors")
+    print(f"group commit speedup: {group['rows_per_second'] / direct['rows_per_second']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""Seed a scratch database, start the API on it and drive every route with concurrent clients.
+
+    python -m benchmarks.load --scale small --concurrency 8 --requests 200 --output results.json
+    python -m benchmarks.load --scale small --check benchmarks/baselines/small.json
+
+Reports requests, errors, shed requests, throughput and p50/p95/p99 latency per endpoint as JSON.
+With --check, exits with status 1 when an endpoint's p95 latency or throughput is worse than the
+baseline by more than --threshold.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import httpx
+
+from benchmarks.seed import add_scale_arguments, participant_names, scale_from_args, seed
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+# The benchmark measures the routes themselves; with admission control on, the default --concurrency
+# exceeds the bulk group's limits and part of the load would be shed. --server-env overrides this.
+DEFAULT_SERVER_ENV = {"ADMISSION_CONTROL": "0"}
+# Load shedding (admission control, a full hashing queue) rather than failure.
+SHED_STATUS_CODES = (429, 503)
+
+
+def _transaction(state, rng):
+    names = state["participants"]
+    return {
+        "amount": round(rng.uniform(1, 500), 2),
+        "whatfor": "load test",
+        "payer": rng.choice(names),
+        "split_between": ", ".join(rng.sample(names, min(3, len(names)))),
+    }
+
+
+def _bill_list_id(state, rng):
+    return rng.choice(state["bill_list_ids"])
+
+
+# Each scenario does any untimed setup and returns the request to time.
+def create_user(client, state, rng):
+    username = f"load-{uuid.uuid4().hex}"
+    return lambda: client.post("/users/", json={"username": username, "password": "benchmark"})
+
+
+def read_users(client, state, rng):
+    return lambda: client.get("/users/")
+
+
+def create_bill_list(client, state, rng):
+    body = {"title": "load test", "participants": [{"name": name} for name in state["participants"]]}
+    return lambda: client.post("/bill_lists/", json=body)
+
+
+def read_bill_list(client, state, rng):
+    bill_list_id = _bill_list_id(state, rng)
+    return lambda: client.get(f"/bill_lists/{bill_list_id}")
+
+
+def read_bill_lists(client, state, rng):
+    return lambda: client.get("/bill_lists/", params={"transactions": "summary"})
+
+
+def create_transaction(client, state, rng):
+    bill_list_id, body = _bill_list_id(state, rng), _transaction(state, rng)
+    return lambda: client.post(f"/bill_lists/{bill_list_id}/transactions/", json=body)
+
+
+def create_transactions_bulk(client, state, rng):
+    bill_list_id = _bill_list_id(state, rng)
+    body = [_transaction(state, rng) for _ in range(100)]
+    return lambda: client.post(f"/bill_lists/{bill_list_id}/transactions/bulk", json=body)
+
+
+def update_transaction(client, state, rng):
+    bill_list_id = _bill_list_id(state, rng)
+    transaction_id = client.post(f"/bill_lists/{bill_list_id}/transactions/", json=_transaction(state, rng)).json()["id"]
+    body = _transaction(state, rng)
+    return lambda: client.patch(f"/bill_lists/{bill_list_id}/transactions/{transaction_id}", json=body)
+
+
+def delete_transaction(client, state, rng):
+    bill_list_id = _bill_list_id(state, rng)
+    transaction_id = client.post(f"/bill_lists/{bill_list_id}/transactions/", json=_transaction(state, rng)).json()["id"]
+    return lambda: client.delete(f"/bill_lists/{bill_list_id}/transactions/{transaction_id}")
+
+
+def read_balance(client, state, rng):
+    bill_list_id = _bill_list_id(state, rng)
+    return lambda: client.get(f"/bill_lists/{bill_list_id}/balance")
+
+
+def read_settlement(client, state, rng):
+    bill_list_id = _bill_list_id(state, rng)
+    return lambda: client.get(f"/bill_lists/{bill_list_id}/settlement")
+
+
+def read_participant_debts(client, state, rng):
+    bill_list_id, name = _bill_list_id(state, rng), rng.choice(state["participants"])
+    return lambda: client.get(f"/bill_lists/{bill_list_id}/participants/{name}/debts")
+
+
+def query_transactions(client, state, rng):
+    bill_list_id, payer = _bill_list_id(state, rng), rng.choice(state["participants"])
+    return lambda: client.get(f"/bill_lists/{bill_list_id}/transactions", params={"payer": payer, "min_amount": 100})
+
+
+def export_transactions(client, state, rng):
+    bill_list_id = _bill_list_id(state, rng)
+    return lambda: client.get(f"/bill_lists/{bill_list_id}/transactions/export")
+
+
+def read_metrics(client, state, rng):
+    return lambda: client.get("/metrics")
+
+
+def delete_bill_list(client, state, rng):
+    body = {"title": "load test", "participants": [{"name": name} for name in state["participants"]]}
+    bill_list_id = client.post("/bill_lists/", json=body).json()["id"]
+    return lambda: client.delete(f"/bill_lists/{bill_list_id}")
+
+
+SCENARIOS = {
+    "POST /users/": create_user,
+    "GET /users/": read_users,
+    "POST /bill_lists/": create_bill_list,
+    "GET /bill_lists/{id}": read_bill_list,
+    "GET /bill_lists/": read_bill_lists,
+    "POST /bill_lists/{id}/transactions/": create_transaction,
+    "POST /bill_lists/{id}/transactions/bulk": create_transactions_bulk,
+    "PATCH /bill_lists/{id}/transactions/{id}": update_transaction,
+    "DELETE /bill_lists/{id}/transactions/{id}": delete_transaction,
+    "GET /bill_lists/{id}/balance": read_balance,
+    "GET /bill_lists/{id}/settlement": read_settlement,
+    "GET /bill_lists/{id}/participants/{name}/debts": read_participant_debts,
+    "GET /bill_lists/{id}/transactions": query_transactions,
+    "GET /bill_lists/{id}/transactions/export": export_transactions,
+    "GET /metrics": read_metrics,
+    "DELETE /bill_lists/{id}": delete_bill_list,
+}
+
+
+def percentile(sorted_values, fraction: float):
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def run_scenario(base_url: str, scenario, requests: int, concurrency: int, state, seed: int = 0):
+    latencies, errors, shed = [], [], []
+    counter = itertools.count()
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        rng = random.Random(seed * 1000 + worker_id)
+        with httpx.Client(base_url=base_url, timeout=120) as client:
+            while next(counter) < requests:
+                call = scenario(client, state, rng)
+                start = time.perf_counter()
+                response = call()
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    if response.status_code in SHED_STATUS_CODES:
+                        shed.append(response.status_code)
+                    elif response.status_code >= 400:
+                        errors.append(response.status_code)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "shed": len(shed),
+        "throughput_rps": round(len(latencies) / wall, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def start_server(database_url: str, port: int, extra_env=None, startup_timeout: float = 60):
+    env = dict(os.environ, DATABASE_URL=database_url, **(extra_env or {}))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=root, env=env,
+    )
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with status {process.returncode}")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/users/", params={"limit": 1}, timeout=1)
+            return process
+        except httpx.TransportError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("server did not start in time")
+
+
+def check_regressions(results, baseline, threshold: float):
+    """Return a message for every endpoint that is slower or has less throughput than the baseline allows.
+
+    An endpoint missing from the baseline is reported too, so a stale baseline cannot pass unnoticed.
+    """
+    regressions = []
+    for name, actual in results["endpoints"].items():
+        expected = baseline["endpoints"].get(name)
+        if expected is None:
+            regressions.append(f"{name}: not in the baseline; record a new one with --save-baseline")
+            continue
+        if actual["p95_ms"] > expected["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {actual['p95_ms']} ms > baseline {expected['p95_ms']} ms")
+        if actual["throughput_rps"] < expected["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {actual['throughput_rps']} rps < baseline {expected['throughput_rps']} rps")
+        if actual["errors"] > expected["errors"]:
+            regressions.append(f"{name}: {actual['errors']} errors > baseline {expected['errors']}")
+        if actual["shed"] > expected.get("shed", 0):
+            regressions.append(f"{name}: {actual['shed']} shed > baseline {expected.get('shed', 0)}")
+    return regressions
+
+
+def run(scale, concurrency: int, requests: int, port: int, endpoints=None, server_env=None, seed_value: int = 0):
+    server_env = dict(DEFAULT_SERVER_ENV, **(server_env or {}))
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = f"sqlite:///{os.path.join(directory, 'load.db')}"
+        bill_list_ids = seed(database_url, seed=seed_value, **scale)
+        state = {"bill_list_ids": bill_list_ids, "participants": participant_names(scale["participants"])}
+        server = start_server(database_url, port, server_env)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            results = {}
+            for name, scenario in SCENARIOS.items():
+                if endpoints and name not in endpoints:
+                    continue
+                results[name] = run_scenario(base_url, scenario, requests, concurrency, state, seed_value)
+        finally:
+            server.terminate()
+            server.wait()
+    return {"scale": scale, "concurrency": concurrency, "requests": requests, "server_env": server_env, "endpoints": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_scale_arguments(parser)
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients per endpoint")
+    parser.add_argument("--requests", type=int, default=200, help="Timed requests per endpoint")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--endpoint", action="append", choices=sorted(SCENARIOS), help="Only benchmark this endpoint (repeatable)")
+    parser.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE", help="Extra environment for the server (repeatable)")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    parser.add_argument("--save-baseline", action="store_true", help=f"Store the results as the baseline for --scale in {BASELINE_DIR}")
+    parser.add_argument("--check", metavar="BASELINE", help="Compare the results against this baseline file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed relative regression for --check")
+    args = parser.parse_args(argv)
+
+    server_env = dict(item.split("=", 1) for item in args.server_env)
+    results = run(scale_from_args(args), args.concurrency, args.requests, args.port, args.endpoint, server_env, args.seed)
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, f"{args.scale}.json"), "w") as f:
+            f.write(report + "\n")
+
+    if args.check:
+        with open(args.check) as f:
+            regressions = check_regressions(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""Fill a database with synthetic users, bill lists, participants and transactions.
+
+    python -m benchmarks.seed sqlite:///./bench.db --scale medium
+"""
+import argparse
+import random
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+import crud
+import hashing
+import schemas
+from models import Base, User
+
+SCALES = {
+    "small": {"users": 20, "bill_lists": 20, "participants": 5, "transactions": 200},
+    "medium": {"users": 200, "bill_lists": 100, "participants": 20, "transactions": 2000},
+    "large": {"users": 1000, "bill_lists": 500, "participants": 50, "transactions": 20000},
+}
+
+CHUNK_SIZE = 5000
+
+
+def participant_names(participants: int):
+    return [f"participant{i}" for i in range(participants)]
+
+
+def synthetic_transactions(rng: random.Random, names, count: int, max_splitters: int = 5):
+    for i in range(count):
+        group = rng.sample(names, rng.randint(1, min(max_splitters, len(names))))
+        yield schemas.TransactionCreate(
+            amount=round(rng.uniform(1, 500), 2),
+            whatfor=f"expense {i}",
+            payer=rng.choice(names),
+            split_between=", ".join(group),
+        )
+
+
+def seed(database_url: str, users: int, bill_lists: int, participants: int, transactions: int, seed: int = 0):
+    """Create the schema at `database_url` and fill it; returns the ids of the created bill lists."""
+    rng = random.Random(seed)
+    engine = create_engine(database_url)
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    try:
+        # bcrypt is deliberately slow; every synthetic user shares one hash.
+        password_hash = hashing.hash_password("benchmark")
+        if users:
+            db.execute(insert(User), [{"username": f"user{i}", "password_hash": password_hash} for i in range(users)])
+            db.commit()
+
+        names = participant_names(participants)
+        bill_list_ids = []
+        for i in range(bill_lists):
+            bill_list = crud.create_bill_list(db, schemas.BillListCreate(
+                title=f"bill list {i}", participants=[schemas.ParticipantCreate(name=name) for name in names]
+            ))
+            bill_list_ids.append(bill_list.id)
+            chunk = []
+            for transaction in synthetic_transactions(rng, names, transactions):
+                chunk.append(transaction)
+                if len(chunk) == CHUNK_SIZE:
+                    crud.create_transactions_bulk(db, bill_list.id, chunk)
+                    chunk = []
+            if chunk:
+                crud.create_transactions_bulk(db, bill_list.id, chunk)
+        return bill_list_ids
+    finally:
+        db.close()
+        engine.dispose()
+
+
+def add_scale_arguments(parser):
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small", help="Preset sizes, overridden by the options below")
+    for option in ("users", "bill-lists", "participants", "transactions"):
+        parser.add_argument(f"--{option}", type=int, help=f"Number of {option.replace('-', ' ')}" + (" per bill list" if option in ("participants", "transactions") else ""))
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, for reproducible data")
+
+
+def scale_from_args(args):
+    scale = dict(SCALES[args.scale])
+    for key in scale:
+        value = getattr(args, key)
+        if value is not None:
+            scale[key] = value
+    return scale
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("database_url")
+    add_scale_arguments(parser)
+    args = parser.parse_args(argv)
+    scale = scale_from_args(args)
+    bill_list_ids = seed(args.database_url, seed=args.seed, **scale)
+    print(f"seeded {len(bill_list_ids)} bill lists: {scale}")
+
+
+if __name__ == "__main__":
+    main()
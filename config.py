@@ -0,0 +1,107 @@
+import os
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def env_int(name: str, default=None):
+    value = os.environ.get(name)
+    return default if value in (None, "") else int(value)
+
+
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./bill.db")
+# Connection pool sizing; unset keeps SQLAlchemy's defaults for the database URL.
+DATABASE_POOL_SIZE = env_int("DATABASE_POOL_SIZE")
+DATABASE_MAX_OVERFLOW = env_int("DATABASE_MAX_OVERFLOW")
+DATABASE_POOL_TIMEOUT = env_int("DATABASE_POOL_TIMEOUT")
+
+# Pragmas applied to every SQLite connection. WAL lets readers proceed while a write is in
+# progress, and synchronous=NORMAL only fsyncs at checkpoints instead of on every commit.
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = env_int("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)
+SQLITE_CACHE_SIZE = env_int("SQLITE_CACHE_SIZE", -64 * 1024)  # Negative values are KiB
+SQLITE_BUSY_TIMEOUT_MS = env_int("SQLITE_BUSY_TIMEOUT_MS", 5000)
+# SQLite only enforces foreign keys, and so ON DELETE CASCADE, when each connection asks for it.
+SQLITE_FOREIGN_KEYS = env_bool("SQLITE_FOREIGN_KEYS", True)
+
+# Comma-separated database URLs to spread bill lists over. When set, DATABASE_URL keeps users and
+# the shard directory, and each bill list lives in shard `bill_list_id % len(SHARD_URLS)` until moved.
+SHARD_URLS = [url.strip() for url in os.environ.get("SHARD_URLS", "").split(",") if url.strip()]
+# Transaction ids each process reserves from the main database at a time.
+SHARD_ID_BLOCK_SIZE = env_int("SHARD_ID_BLOCK_SIZE", 1000)
+
+# Funnel single-transaction inserts through one writer thread that commits them in batches.
+GROUP_COMMIT = env_bool("GROUP_COMMIT")
+GROUP_COMMIT_MAX_BATCH = env_int("GROUP_COMMIT_MAX_BATCH", 256)
+# How long the writer waits for more inserts to join a batch that is not yet full.
+GROUP_COMMIT_MAX_WAIT_MS = env_int("GROUP_COMMIT_MAX_WAIT_MS", 2)
+
+# Bill lists with more transactions than this are hidden at once and purged in the background.
+SOFT_DELETE_THRESHOLD = env_int("SOFT_DELETE_THRESHOLD", 10000)
+# Transactions removed per purge transaction, and the pause between batches that lets other writers in.
+PURGE_BATCH_SIZE = env_int("PURGE_BATCH_SIZE", 5000)
+PURGE_PAUSE_MS = env_int("PURGE_PAUSE_MS", 10)
+
+# Serve requests from an async engine/session (requires aiosqlite) instead of the threadpool.
+DATABASE_ASYNC = env_bool("DATABASE_ASYNC")
+
+# bcrypt cost factor; each +1 doubles the time to hash and verify a password.
+BCRYPT_ROUNDS = env_int("BCRYPT_ROUNDS", 12)
+# Processes reserved for password hashing; 0 hashes in the request threadpool instead.
+HASH_WORKERS = env_int("HASH_WORKERS", min(4, os.cpu_count() or 1))
+# Hash jobs allowed to wait for a worker before new signups are rejected with 503.
+HASH_QUEUE_SIZE = env_int("HASH_QUEUE_SIZE", 64)
+
+# Split rows above which `engine=auto` balance recomputation switches from Python loops to NumPy.
+BALANCE_NUMPY_THRESHOLD = env_int("BALANCE_NUMPY_THRESHOLD", 20000)
+
+# Build read-only responses from row tuples and encode them with orjson (if installed), skipping
+# ORM objects and Pydantic models.
+FAST_JSON = env_bool("FAST_JSON", True)
+
+# Balance streams: how long a change waits for further writes to the same list before one balance
+# read is pushed to subscribers, and how many unsent snapshots a slow subscriber may fall behind.
+BALANCE_STREAM_COALESCE_MS = env_int("BALANCE_STREAM_COALESCE_MS", 50)
+BALANCE_STREAM_BUFFER = env_int("BALANCE_STREAM_BUFFER", 8)
+# Seconds between keepalive comments on an idle stream.
+BALANCE_STREAM_KEEPALIVE_S = env_int("BALANCE_STREAM_KEEPALIVE_S", 15)
+
+# Upper bound on the serialized GET responses kept in memory; 0 disables the cache.
+RESPONSE_CACHE_MAX_BYTES = env_int("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+# Admission control for expensive route groups: at most CONCURRENCY requests of a group run at once,
+# at most QUEUE more wait, each for at most MAX_WAIT_MS; the rest are shed with 429 or 503.
+ADMISSION_CONTROL = env_bool("ADMISSION_CONTROL", True)
+
+
+def _admission_limits(group: str, concurrency: int, queue: int, max_wait_ms: int):
+    prefix = f"ADMISSION_{group.upper()}_"
+    return (
+        env_int(prefix + "CONCURRENCY", concurrency),
+        env_int(prefix + "QUEUE", queue),
+        env_int(prefix + "MAX_WAIT_MS", max_wait_ms),
+    )
+
+
+ADMISSION_LIMITS = {
+    # Balances, settlements and debts; recomputing a big list's balance can take seconds.
+    "balance": _admission_limits("balance", 8, 32, 1000),
+    # GET /bill_lists/, whose pages can carry up to 1000 lists with all their transactions.
+    "listing": _admission_limits("listing", 4, 16, 1000),
+    # Bulk imports and exports, which hold a connection for as long as the data flows.
+    "bulk": _admission_limits("bulk", 2, 4, 5000),
+    # Signups, which spend most of their time in bcrypt.
+    "signup": _admission_limits("signup", 8, 32, 2000),
+    # Open balance streams; these never queue.
+    "streams": _admission_limits("streams", 1000, 0, 0),
+} if ADMISSION_CONTROL else {}
+
+# Record per-route latency and SQL statistics and serve them at /metrics.
+METRICS = env_bool("METRICS", True)
+# A request running the same SELECT this many times is reported as a likely N+1 query pattern.
+N_PLUS_ONE_THRESHOLD = env_int("N_PLUS_ONE_THRESHOLD", 10)
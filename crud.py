@@ -1,15 +1,29 @@
-from sqlalchemy.orm import Session
-from passlib.context import CryptContext
-from models import User, BillList, Participant, Transaction
+import heapq
+from typing import List
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.dialects.sqlite import insert
+from hashing import pwd_context
+import balance_engine
+from models import User, BillList, BillListShard, IdBlock, Item, Participant, Transaction, TransactionSplit, BalanceEntry
 from schemas import UserCreate, BillListCreate, TransactionCreate, TransactionUpdate
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Amounts closer to zero than this are treated as settled.
+BALANCE_EPSILON = 1e-9
+
+# Columns of an exported transaction, in TransactionOut field order.
+TRANSACTION_EXPORT_COLUMNS = (Transaction.amount, Transaction.whatfor, Transaction.payer, Transaction.split_between, Transaction.id, Transaction.bill_list_id)
+TRANSACTION_FIELDS = tuple(column.key for column in TRANSACTION_EXPORT_COLUMNS)
+
+class UnknownParticipantError(ValueError):
+    pass
 
 def get_user_by_username(db: Session, username: str):
     return db.query(User).filter(User.username == username).first()
 
-def create_user(db: Session, user: UserCreate):
-    hashed_password = pwd_context.hash(user.password)
+def create_user(db: Session, user: UserCreate, hashed_password: str = None):
+    if hashed_password is None:
+        hashed_password = pwd_context.hash(user.password)
     db_user = User(username=user.username, password_hash=hashed_password)
     db.add(db_user)
     db.commit()
@@ -19,8 +33,8 @@ def create_user(db: Session, user: UserCreate):
 def get_users(db: Session, skip: int = 0, limit: int = 100):
     return db.query(User).offset(skip).limit(limit).all()
 
-def create_bill_list(db: Session, bill_list: BillListCreate):
-    db_bill_list = BillList(title=bill_list.title)
+def create_bill_list(db: Session, bill_list: BillListCreate, bill_list_id: int = None):
+    db_bill_list = BillList(id=bill_list_id, title=bill_list.title)
     db.add(db_bill_list)
     db.commit()
     db.refresh(db_bill_list)
@@ -30,65 +44,601 @@ def create_bill_list(db: Session, bill_list: BillListCreate):
         db.add(db_participant)
 
     db.commit()
-    db.refresh(db_bill_list)
 
-    return db_bill_list
+    return get_bill_list(db, db_bill_list.id)
 
 def get_bill_list(db: Session, bill_list_id: int):
-    return db.query(BillList).filter(BillList.id == bill_list_id).first()
+    return db.query(BillList).options(
+        selectinload(BillList.participants), selectinload(BillList.transactions)
+    ).filter(BillList.id == bill_list_id, BillList.deleted_at.is_(None)).first()
+
+def bill_list_exists(db: Session, bill_list_id: int):
+    return db.query(BillList.id).filter(BillList.id == bill_list_id, BillList.deleted_at.is_(None)).first() is not None
+
+def get_bill_list_version(db: Session, bill_list_id: int, include_deleted: bool = False):
+    query = db.query(BillList.version).filter(BillList.id == bill_list_id)
+    if not include_deleted:
+        query = query.filter(BillList.deleted_at.is_(None))
+    return query.scalar()
+
+def bump_bill_list_version(db: Session, bill_list_id: int):
+    # Part of the caller's transaction, so the new version becomes visible with the write itself.
+    db.query(BillList).filter(BillList.id == bill_list_id).update(
+        {BillList.version: BillList.version + 1}, synchronize_session=False
+    )
+
+def get_bill_lists(db: Session, limit: int = None, after_id: int = None, with_transactions: bool = True):
+    # Keyset pagination on the primary key; relationships are loaded with one extra query each.
+    query = db.query(BillList).options(selectinload(BillList.participants)).filter(BillList.deleted_at.is_(None)).order_by(BillList.id)
+    if with_transactions:
+        query = query.options(selectinload(BillList.transactions))
+    if after_id is not None:
+        query = query.filter(BillList.id > after_id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+def get_bill_list_payloads(db: Session, bill_list_ids: List[int] = None, limit: int = None, after_id: int = None, transactions: str = "full"):
+    """Build BillListOut-shaped dicts straight from row tuples, without ORM objects or Pydantic.
+
+    Covers the given bill lists, or else a keyset page of all of them, in id order. `transactions`
+    is "full", "summary" (count and total) or "none", as for GET /bill_lists/.
+    """
+    query = db.query(BillList.title, BillList.id).filter(BillList.deleted_at.is_(None)).order_by(BillList.id)
+    if bill_list_ids is not None:
+        query = query.filter(BillList.id.in_(bill_list_ids))
+    if after_id is not None:
+        query = query.filter(BillList.id > after_id)
+    if limit is not None:
+        query = query.limit(limit)
+    payloads = {bill_list_id: {"title": title, "id": bill_list_id, "participants": []} for title, bill_list_id in query}
+    if not payloads:
+        return []
+
+    participants = db.query(Participant.bill_list_id, Participant.name).filter(Participant.bill_list_id.in_(payloads)).order_by(Participant.id)
+    for bill_list_id, name in participants:
+        payloads[bill_list_id]["participants"].append({"name": name})
+    if transactions == "full":
+        for payload in payloads.values():
+            payload["transactions"] = []
+        rows = db.query(*TRANSACTION_EXPORT_COLUMNS).filter(Transaction.bill_list_id.in_(payloads)).order_by(Transaction.id)
+        for row in rows:
+            payloads[row.bill_list_id]["transactions"].append(dict(zip(TRANSACTION_FIELDS, row)))
+    elif transactions == "summary":
+        for bill_list_id, (count, total) in get_transaction_summaries(db, list(payloads)).items():
+            payloads[bill_list_id]["transaction_count"] = count
+            payloads[bill_list_id]["transaction_total"] = total
+    return list(payloads.values())
+
+def get_bill_list_page(db: Session, limit: int, after_id: int = None, transactions: str = "full", as_dicts: bool = False):
+    """One keyset page of bill lists shaped like BillListPageOut.
+
+    Items are dicts, except for `transactions="full"` without `as_dicts`, which returns the ORM objects.
+    """
+    if as_dicts:
+        return get_bill_list_payloads(db, limit=limit, after_id=after_id, transactions=transactions)
+    bill_lists = get_bill_lists(db, limit=limit, after_id=after_id, with_transactions=transactions == "full")
+    if transactions == "full":
+        return bill_lists
+    page = [{"id": bill_list.id, "title": bill_list.title, "participants": bill_list.participants} for bill_list in bill_lists]
+    if transactions == "summary":
+        summaries = get_transaction_summaries(db, [bill_list.id for bill_list in bill_lists])
+        for item in page:
+            item["transaction_count"], item["transaction_total"] = summaries[item["id"]]
+    return page
+
+def get_bill_list_sizes(db: Session):
+    """Number of transactions of every live bill list stored in this database, including empty lists.
+
+    Soft-deleted lists are left out: they are no longer in the shard directory and cannot be moved.
+    """
+    return dict(
+        db.query(BillList.id, func.count(Transaction.id))
+        .outerjoin(Transaction, Transaction.bill_list_id == BillList.id)
+        .filter(BillList.deleted_at.is_(None))
+        .group_by(BillList.id)
+    )
+
+def get_max_transaction_id(db: Session):
+    return db.query(func.max(Transaction.id)).scalar() or 0
+
+def get_max_bill_list_id(db: Session):
+    """Highest bill list id stored or registered in this database, deleted lists included."""
+    return max(db.query(func.max(BillList.id)).scalar() or 0, db.query(func.max(BillListShard.bill_list_id)).scalar() or 0)
+
+def get_transaction_summaries(db: Session, bill_list_ids: List[int]):
+    summaries = {bill_list_id: (0, 0.0) for bill_list_id in bill_list_ids}
+    totals = db.query(Transaction.bill_list_id, func.count(Transaction.id), func.sum(Transaction.amount)).filter(
+        Transaction.bill_list_id.in_(bill_list_ids)
+    ).group_by(Transaction.bill_list_id)
+    for bill_list_id, count, total in totals:
+        summaries[bill_list_id] = (count, total or 0.0)
+    return summaries
+
+def iter_transaction_rows(db: Session, bill_list_id: int, batch_size: int = 1000):
+    """Yield the bill list's transactions in id order as lists of at most `batch_size` row tuples.
+
+    yield_per fetches from the cursor batch by batch instead of buffering the whole result.
+    """
+    query = db.query(*TRANSACTION_EXPORT_COLUMNS).filter(Transaction.bill_list_id == bill_list_id).order_by(Transaction.id)
+    yield from db.execute(query.statement.execution_options(yield_per=batch_size)).partitions()
+
+def query_transactions(
+    db: Session,
+    bill_list_id: int,
+    payer: str = None,
+    participant: str = None,
+    min_amount: float = None,
+    max_amount: float = None,
+    min_id: int = None,
+    max_id: int = None,
+    after_id: int = None,
+    limit: int = 100,
+    as_dicts: bool = False,
+):
+    """Return one keyset page of the bill list's matching transactions, plus the count and sum of all matches.
+
+    With `as_dicts` the page holds TransactionOut-shaped dicts built from row tuples instead of ORM objects.
+    """
+    conditions = [Transaction.bill_list_id == bill_list_id]
+    if payer is not None:
+        conditions.append(Transaction.payer == payer)
+    if participant is not None:
+        conditions.append(Transaction.id.in_(
+            db.query(TransactionSplit.transaction_id).join(Participant, Participant.id == TransactionSplit.participant_id).filter(
+                TransactionSplit.bill_list_id == bill_list_id, Participant.name == participant
+            )
+        ))
+    if min_amount is not None:
+        conditions.append(Transaction.amount >= min_amount)
+    if max_amount is not None:
+        conditions.append(Transaction.amount <= max_amount)
+    if min_id is not None:
+        conditions.append(Transaction.id >= min_id)
+    if max_id is not None:
+        conditions.append(Transaction.id <= max_id)
 
-def get_bill_lists(db: Session):
-    return db.query(BillList).all()
+    count, total = db.query(func.count(Transaction.id), func.coalesce(func.sum(Transaction.amount), 0.0)).filter(*conditions).one()
+    page = db.query(*TRANSACTION_EXPORT_COLUMNS) if as_dicts else db.query(Transaction)
+    page = page.filter(*conditions)
+    if after_id is not None:
+        page = page.filter(Transaction.id > after_id)
+    page = page.order_by(Transaction.id).limit(limit).all()
+    if as_dicts:
+        page = [dict(zip(TRANSACTION_FIELDS, row)) for row in page]
+    return page, count, total
+
+def parse_split_between(split_between: str):
+    return split_between.split(", ") if split_between else []
+
+def get_participant_ids(db: Session, bill_list_id: int):
+    participant_ids = {}
+    for participant_id, name in db.query(Participant.id, Participant.name).filter(Participant.bill_list_id == bill_list_id):
+        participant_ids.setdefault(name, participant_id)
+    return participant_ids
+
+def transaction_shares(transaction, participant_ids):
+    """Return {participant name: share} for `transaction`, which may be a model or a schema."""
+    if transaction.payer not in participant_ids:
+        raise UnknownParticipantError(f"Unknown participant: {transaction.payer}")
+    splitters = parse_split_between(transaction.split_between)
+    shares = {}
+    for splitter in splitters:
+        if splitter not in participant_ids:
+            raise UnknownParticipantError(f"Unknown participant: {splitter}")
+        shares[splitter] = shares.get(splitter, 0.0) + float(transaction.amount) / len(splitters)
+    return shares
+
+def build_transaction_splits(transaction, participant_ids):
+    return [
+        TransactionSplit(participant_id=participant_ids[name], bill_list_id=transaction.bill_list_id, share=share)
+        for name, share in transaction_shares(transaction, participant_ids).items()
+    ]
+
+def _reserve_transaction_ids(db: Session, count: int):
+    # Shard sessions carry an allocator of ids unique across shards; elsewhere the database assigns them.
+    reserve = db.info.get("reserve_transaction_ids")
+    return reserve(count) if reserve is not None else None
 
 def create_transaction(db: Session, bill_list_id: int, transaction: TransactionCreate):
-    db_transaction = Transaction(**transaction.dict(), bill_list_id=bill_list_id)
+    reserved = _reserve_transaction_ids(db, 1)
+    db_transaction = Transaction(**transaction.dict(), bill_list_id=bill_list_id, id=reserved[0] if reserved else None)
+    db_transaction.splits = build_transaction_splits(db_transaction, get_participant_ids(db, bill_list_id))
     db.add(db_transaction)
+    apply_balance_deltas(db, bill_list_id, transaction_balance_deltas(db_transaction))
+    bump_bill_list_version(db, bill_list_id)
     db.commit()
     db.refresh(db_transaction)
     return db_transaction
 
-def calculate_balance(db: Session, bill_list_id: int):
-    bill_list = db.query(BillList).filter(BillList.id == bill_list_id).first()
-    participants = [participant.name for participant in bill_list.participants]
-    balance_record = {p: {other: 0.0 for other in participants} for p in participants}
+def insert_transactions(db: Session, bill_list_id: int, transactions: List[TransactionCreate]):
+    """Insert `transactions` with one executemany per table, without committing.
+
+    Rows naming unknown participants are skipped; returns the new id of every row (None when
+    skipped) and the (index, message) of every skipped row.
+    """
+    participant_ids = get_participant_ids(db, bill_list_id)
+    valid, errors, deltas = [], [], {}
+    for index, transaction in enumerate(transactions):
+        try:
+            shares = transaction_shares(transaction, participant_ids)
+        except UnknownParticipantError as e:
+            errors.append((index, str(e)))
+            continue
+        valid.append((index, transaction, shares))
+        transaction_balance_deltas(transaction, deltas=deltas)
+
+    ids = [None] * len(transactions)
+    if valid:
+        rows = [dict(transaction.dict(), bill_list_id=bill_list_id) for _, transaction, _ in valid]
+        reserved = _reserve_transaction_ids(db, len(rows))
+        if reserved is not None:
+            for row, transaction_id in zip(rows, reserved):
+                row["id"] = transaction_id
+        transaction_ids = db.scalars(insert(Transaction).returning(Transaction.id, sort_by_parameter_order=True), rows).all()
+        db.execute(insert(TransactionSplit), [
+            {"transaction_id": transaction_id, "participant_id": participant_ids[name], "bill_list_id": bill_list_id, "share": share}
+            for transaction_id, (_, _, shares) in zip(transaction_ids, valid)
+            for name, share in shares.items()
+        ])
+        apply_balance_deltas(db, bill_list_id, deltas)
+        bump_bill_list_version(db, bill_list_id)
+        for transaction_id, (index, _, _) in zip(transaction_ids, valid):
+            ids[index] = transaction_id
+    return ids, errors
+
+def create_transactions_bulk(db: Session, bill_list_id: int, transactions: List[TransactionCreate]):
+    """Insert `transactions` with one executemany per table and a single commit.
+
+    Returns the number inserted and the (index, message) of every skipped row.
+    """
+    ids, errors = insert_transactions(db, bill_list_id, transactions)
+    db.commit()
+    return len(ids) - len(errors), errors
+
+def transaction_balance_deltas(transaction, sign: int = 1, deltas=None):
+    """Return the {(participant, other): amount} changes `transaction` makes to the balance."""
+    if deltas is None:
+        deltas = {}
+    if transaction.split_between:
+        splitters = parse_split_between(transaction.split_between)
+        amount_per_person = sign * float(transaction.amount) / len(splitters)
+        for splitter in splitters:
+            if transaction.payer != splitter:
+                deltas[(transaction.payer, splitter)] = deltas.get((transaction.payer, splitter), 0.0) + amount_per_person
+                deltas[(splitter, transaction.payer)] = deltas.get((splitter, transaction.payer), 0.0) - amount_per_person
+    return deltas
 
-    for transaction in bill_list.transactions:
-        if transaction.split_between:
-            splitters = transaction.split_between.split(", ")
-            amount_per_person = float(transaction.amount) / len(splitters)
-            for splitter in splitters:
-                if transaction.payer != splitter:
-                    balance_record[transaction.payer][splitter] += amount_per_person
-                    balance_record[splitter][transaction.payer] -= amount_per_person
+def apply_balance_deltas(db: Session, bill_list_id: int, deltas):
+    # Increment in SQL rather than read-modify-write so concurrent writers can't lose updates.
+    if not deltas:
+        return
+    stmt = insert(BalanceEntry)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[BalanceEntry.bill_list_id, BalanceEntry.participant, BalanceEntry.other],
+        set_={"amount": BalanceEntry.amount + stmt.excluded.amount},
+    )
+    db.execute(stmt, [
+        {"bill_list_id": bill_list_id, "participant": participant, "other": other, "amount": amount}
+        for (participant, other), amount in deltas.items()
+    ])
 
+def _empty_balance(db: Session, bill_list_id: int):
+    participants = [name for (name,) in db.query(Participant.name).filter(Participant.bill_list_id == bill_list_id)]
+    return {p: {other: 0.0 for other in participants} for p in participants}
+
+def calculate_balance(db: Session, bill_list_id: int, sparse: bool = False):
+    # The sparse form leaves out every pair whose balance is zero instead of listing all N x N pairs.
+    balance_record = {} if sparse else _empty_balance(db, bill_list_id)
+    entries = db.query(BalanceEntry.participant, BalanceEntry.other, BalanceEntry.amount).filter(
+        BalanceEntry.bill_list_id == bill_list_id
+    )
+    if sparse:
+        entries = entries.filter(func.abs(BalanceEntry.amount) > BALANCE_EPSILON)
+    for participant, other, amount in entries:
+        balance_record.setdefault(participant, {})[other] = amount
     return balance_record
 
+def get_balance_snapshot(db: Session, bill_list_id: int):
+    """(version, dense balance) of a bill list, or None once it is gone or soft-deleted."""
+    version = get_bill_list_version(db, bill_list_id)
+    if version is None:
+        return None
+    return version, calculate_balance(db, bill_list_id)
+
+def sparse_balance(balance_record):
+    sparse = {}
+    for participant, row in balance_record.items():
+        row = {other: amount for other, amount in row.items() if abs(amount) > BALANCE_EPSILON}
+        if row:
+            sparse[participant] = row
+    return sparse
+
+def get_net_positions(db: Session, bill_list_id: int):
+    """Return {participant: amount}; positive amounts are owed to the participant, negative ones owed by them."""
+    positions = {name: 0.0 for (name,) in db.query(Participant.name).filter(Participant.bill_list_id == bill_list_id)}
+    totals = db.query(BalanceEntry.participant, func.sum(BalanceEntry.amount)).filter(
+        BalanceEntry.bill_list_id == bill_list_id
+    ).group_by(BalanceEntry.participant)
+    for participant, total in totals:
+        positions[participant] = total
+    return positions
+
+def settle_debts(positions):
+    """Turn net positions into payer -> payee transfers that settle every debt.
+
+    Greedily matches the largest creditor with the largest debtor, so there are at most
+    len(positions) - 1 transfers.
+    """
+    creditors = [(-amount, name) for name, amount in positions.items() if amount > BALANCE_EPSILON]
+    debtors = [(amount, name) for name, amount in positions.items() if amount < -BALANCE_EPSILON]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    transfers = []
+    while creditors and debtors:
+        credit, payee = heapq.heappop(creditors)
+        debt, payer = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append({"payer": payer, "payee": payee, "amount": amount})
+        if -credit - amount > BALANCE_EPSILON:
+            heapq.heappush(creditors, (credit + amount, payee))
+        if -debt - amount > BALANCE_EPSILON:
+            heapq.heappush(debtors, (debt + amount, payer))
+    return transfers
+
+def calculate_settlement(db: Session, bill_list_id: int):
+    return settle_debts(get_net_positions(db, bill_list_id))
+
+def _history_balance_deltas(db: Session, bill_list_id: int):
+    totals = db.query(Transaction.payer, Participant.name, func.sum(TransactionSplit.share)).select_from(TransactionSplit).join(
+        Transaction, Transaction.id == TransactionSplit.transaction_id
+    ).join(
+        Participant, Participant.id == TransactionSplit.participant_id
+    ).filter(
+        TransactionSplit.bill_list_id == bill_list_id,
+        Transaction.payer != Participant.name,
+    ).group_by(Transaction.payer, Participant.name)
+
+    deltas = {}
+    for payer, splitter, total in totals:
+        deltas[(payer, splitter)] = deltas.get((payer, splitter), 0.0) + total
+        deltas[(splitter, payer)] = deltas.get((splitter, payer), 0.0) - total
+    return deltas
+
+def _split_rows(db: Session, bill_list_id: int):
+    return db.query(Transaction.payer, Participant.name, TransactionSplit.share).select_from(TransactionSplit).join(
+        Transaction, Transaction.id == TransactionSplit.transaction_id
+    ).join(
+        Participant, Participant.id == TransactionSplit.participant_id
+    ).filter(TransactionSplit.bill_list_id == bill_list_id).all()
+
+def recalculate_balance(db: Session, bill_list_id: int, engine: str = "sql"):
+    """Recompute the balance from the full transaction history, bypassing the ledger.
+
+    The "sql" engine aggregates in the database; "python", "numpy" and "auto" fetch the split rows
+    and aggregate them with `balance_engine`.
+    """
+    if engine != "sql":
+        participants = [name for (name,) in db.query(Participant.name).filter(Participant.bill_list_id == bill_list_id)]
+        rows = _split_rows(db, bill_list_id)
+        payers, splitters, shares = zip(*rows) if rows else ((), (), ())
+        return balance_engine.compute_balance(participants, payers, splitters, shares, engine)
+
+    balance_record = _empty_balance(db, bill_list_id)
+    for (participant, other), amount in _history_balance_deltas(db, bill_list_id).items():
+        row = balance_record.setdefault(participant, {})
+        row[other] = row.get(other, 0.0) + amount
+    return balance_record
+
+def rebuild_balance_ledger(db: Session, bill_list_id: int):
+    db.query(BalanceEntry).filter(BalanceEntry.bill_list_id == bill_list_id).delete(synchronize_session=False)
+    apply_balance_deltas(db, bill_list_id, _history_balance_deltas(db, bill_list_id))
+    bump_bill_list_version(db, bill_list_id)
+    db.commit()
+
+def verify_balance_ledger(db: Session, bill_list_id: int, tolerance: float = 1e-6):
+    """Return the (participant, other, ledger, expected) pairs where the ledger has drifted."""
+    ledger = calculate_balance(db, bill_list_id)
+    expected = recalculate_balance(db, bill_list_id)
+    drift = []
+    for participant in set(ledger) | set(expected):
+        ledger_row = ledger.get(participant, {})
+        expected_row = expected.get(participant, {})
+        for other in set(ledger_row) | set(expected_row):
+            ledger_amount = ledger_row.get(other, 0.0)
+            expected_amount = expected_row.get(other, 0.0)
+            if abs(ledger_amount - expected_amount) > tolerance:
+                drift.append((participant, other, ledger_amount, expected_amount))
+    return drift
+
+def get_participant_debts(db: Session, bill_list_id: int, name: str):
+    """Return {other: amount} that `name` owes each other participant; negative means `name` is owed."""
+    owes = Participant.name == name
+    other = case((owes, Transaction.payer), else_=Participant.name)
+    totals = db.query(other, func.sum(case((owes, TransactionSplit.share), else_=-TransactionSplit.share))).select_from(TransactionSplit).join(
+        Transaction, Transaction.id == TransactionSplit.transaction_id
+    ).join(
+        Participant, Participant.id == TransactionSplit.participant_id
+    ).filter(
+        TransactionSplit.bill_list_id == bill_list_id,
+        Transaction.payer != Participant.name,
+        (Participant.name == name) | (Transaction.payer == name),
+    ).group_by(other)
+    return {other_name: total for other_name, total in totals}
+
+def migrate_transaction_splits(db: Session, batch_size: int = 1000):
+    """Populate transaction_splits for transactions stored before the table existed.
+
+    Returns the number of migrated transactions and the ids of those naming unknown participants.
+    """
+    migrated, skipped = 0, []
+    participant_ids = {}
+    last_id = 0
+    while True:
+        batch = db.query(Transaction).filter(Transaction.id > last_id, ~Transaction.splits.any()).order_by(Transaction.id).limit(batch_size).all()
+        if not batch:
+            break
+        for transaction in batch:
+            if transaction.bill_list_id not in participant_ids:
+                participant_ids[transaction.bill_list_id] = get_participant_ids(db, transaction.bill_list_id)
+            try:
+                transaction.splits = build_transaction_splits(transaction, participant_ids[transaction.bill_list_id])
+            except UnknownParticipantError:
+                skipped.append(transaction.id)
+                continue
+            migrated += 1
+        last_id = batch[-1].id
+        db.commit()
+    return migrated, skipped
+
 def delete_transaction(db: Session, bill_list_id: int, transaction_id: int):
     transaction = db.query(Transaction).filter(
         Transaction.id == transaction_id,
         Transaction.bill_list_id == bill_list_id
     ).first()
     if transaction:
+        apply_balance_deltas(db, bill_list_id, transaction_balance_deltas(transaction, sign=-1))
         db.delete(transaction)
+        bump_bill_list_version(db, bill_list_id)
         db.commit()
         return True
     return False
 
+def count_transactions(db: Session, bill_list_id: int):
+    return db.query(func.count(Transaction.id)).filter(Transaction.bill_list_id == bill_list_id).scalar()
+
+def _delete_bill_list_rows(db: Session, bill_list_id: int):
+    # One DELETE per table instead of relying on ON DELETE CASCADE, which databases created before
+    # the cascading foreign keys don't have.
+    for model in (BalanceEntry, TransactionSplit, Transaction, Participant, Item):
+        db.query(model).filter(model.bill_list_id == bill_list_id).delete(synchronize_session=False)
+    db.query(BillList).filter(BillList.id == bill_list_id).delete(synchronize_session=False)
+
 def delete_bill_list(db: Session, bill_list_id: int):
-    bill_list = db.query(BillList).filter(BillList.id == bill_list_id).first()
-    if bill_list:
-        db.delete(bill_list)
-        db.commit()
-        return True
-    return False
+    if not bill_list_exists(db, bill_list_id):
+        return False
+    _delete_bill_list_rows(db, bill_list_id)
+    db.commit()
+    return True
+
+def soft_delete_bill_list(db: Session, bill_list_id: int):
+    """Hide a bill list from every read and write at once; purge_bill_list_batch removes its rows later."""
+    hidden = db.query(BillList).filter(BillList.id == bill_list_id, BillList.deleted_at.is_(None)).update(
+        {BillList.deleted_at: func.current_timestamp(), BillList.version: BillList.version + 1}, synchronize_session=False
+    )
+    db.commit()
+    return hidden > 0
+
+def get_soft_deleted_bill_list_ids(db: Session):
+    return [id_ for (id_,) in db.query(BillList.id).filter(BillList.deleted_at.isnot(None)).order_by(BillList.id)]
+
+def purge_bill_list_batch(db: Session, bill_list_id: int, batch_size: int = 5000):
+    """Delete the next `batch_size` transactions of a soft-deleted bill list, or the list itself once none are left.
+
+    Returns the number of transactions deleted; 0 means the list is gone.
+    """
+    ids = [id_ for (id_,) in db.query(Transaction.id).filter(Transaction.bill_list_id == bill_list_id).order_by(Transaction.id).limit(batch_size)]
+    if ids:
+        # Primary key lookups; filtering splits by bill list would rescan the whole list every batch.
+        db.query(TransactionSplit).filter(TransactionSplit.transaction_id.in_(ids)).delete(synchronize_session=False)
+        db.query(Transaction).filter(Transaction.bill_list_id == bill_list_id, Transaction.id <= ids[-1]).delete(synchronize_session=False)
+    else:
+        _delete_bill_list_rows(db, bill_list_id)
+    db.commit()
+    return len(ids)
 
 def update_transaction(db: Session, bill_list_id: int, transaction_id: int, transaction_update: TransactionUpdate):
     transaction = db.query(Transaction).filter(Transaction.id == transaction_id, Transaction.bill_list_id == bill_list_id).first()
     if transaction:
+        deltas = transaction_balance_deltas(transaction, sign=-1)
         transaction_data = transaction_update.dict(exclude_unset=True)
         for key, value in transaction_data.items():
             setattr(transaction, key, value)
+        if transaction_data.keys() & {"amount", "payer", "split_between"}:
+            transaction.splits = build_transaction_splits(transaction, get_participant_ids(db, bill_list_id))
+        apply_balance_deltas(db, bill_list_id, transaction_balance_deltas(transaction, deltas=deltas))
+        bump_bill_list_version(db, bill_list_id)
         db.commit()
         db.refresh(transaction)
         return transaction
     return None
+
+# Shard directory; these take a session on the main database.
+
+def register_bill_list(db: Session, shard_count: int, start: int = 1):
+    """Allocate a new bill list id, at least `start`, and assign it to shard `id % shard_count`."""
+    bill_list_id = reserve_id_block(db, "bill_lists", 1, start)
+    shard = bill_list_id % shard_count
+    db.add(BillListShard(bill_list_id=bill_list_id, shard=shard))
+    db.commit()
+    return bill_list_id, shard
+
+def get_bill_list_shard(db: Session, bill_list_id: int):
+    return db.query(BillListShard.shard).filter(BillListShard.bill_list_id == bill_list_id).scalar()
+
+def get_bill_list_shards(db: Session):
+    return dict(db.query(BillListShard.bill_list_id, BillListShard.shard))
+
+def set_bill_list_shard(db: Session, bill_list_id: int, shard: int):
+    stmt = insert(BillListShard).values(bill_list_id=bill_list_id, shard=shard)
+    db.execute(stmt.on_conflict_do_update(index_elements=[BillListShard.bill_list_id], set_={"shard": shard}))
+    db.commit()
+
+def get_unsharded_bill_list_ids(db: Session):
+    """Live bill lists stored in this (main) database that the shard directory does not know about."""
+    registered = db.query(BillListShard.bill_list_id).filter(BillListShard.bill_list_id == BillList.id).exists()
+    return [id_ for (id_,) in db.query(BillList.id).filter(BillList.deleted_at.is_(None), ~registered).order_by(BillList.id)]
+
+def unregister_bill_list(db: Session, bill_list_id: int):
+    db.query(BillListShard).filter(BillListShard.bill_list_id == bill_list_id).delete(synchronize_session=False)
+    db.commit()
+
+def reserve_id_block(db: Session, name: str, size: int, start: int = 1):
+    """Atomically reserve the next `size` ids of sequence `name`, none below `start`; returns the first."""
+    stmt = insert(IdBlock).values(name=name, next_id=start + size)
+    # Two-argument max() is SQLite's scalar maximum, not the aggregate.
+    next_id = db.scalar(stmt.on_conflict_do_update(index_elements=[IdBlock.name], set_={"next_id": func.max(IdBlock.next_id, start) + size}).returning(IdBlock.next_id))
+    db.commit()
+    return next_id - size
+
+def copy_bill_list(source: Session, target: Session, bill_list_id: int):
+    """Copy a bill list and all of its rows from one shard to another without committing.
+
+    Transaction ids are kept (they are unique across shards and visible to clients); participant
+    ids are internal and are reassigned by the target. Returns the version that was copied.
+    """
+    bill_list = source.query(BillList).filter(BillList.id == bill_list_id).one()
+    target.add(BillList(id=bill_list.id, title=bill_list.title, version=bill_list.version, user_id=bill_list.user_id, deleted_at=bill_list.deleted_at))
+    target.flush()
+
+    participant_ids = {}
+    for participant in source.query(Participant).filter(Participant.bill_list_id == bill_list_id).order_by(Participant.id):
+        copy = Participant(name=participant.name, bill_list_id=bill_list_id)
+        target.add(copy)
+        target.flush()
+        participant_ids[participant.id] = copy.id
+    for item in source.query(Item).filter(Item.bill_list_id == bill_list_id):
+        target.add(Item(title=item.title, description=item.description, due_date=item.due_date, status=item.status, bill_list_id=bill_list_id))
+
+    for rows in iter_transaction_rows(source, bill_list_id):
+        target.execute(insert(Transaction), [dict(zip(TRANSACTION_FIELDS, row)) for row in rows])
+    splits = source.query(TransactionSplit.transaction_id, TransactionSplit.participant_id, TransactionSplit.share).filter(
+        TransactionSplit.bill_list_id == bill_list_id
+    )
+    for rows in source.execute(splits.statement.execution_options(yield_per=1000)).partitions():
+        target.execute(insert(TransactionSplit), [
+            {"transaction_id": transaction_id, "participant_id": participant_ids[participant_id], "bill_list_id": bill_list_id, "share": share}
+            for transaction_id, participant_id, share in rows
+        ])
+    balances = source.query(BalanceEntry.participant, BalanceEntry.other, BalanceEntry.amount).filter(BalanceEntry.bill_list_id == bill_list_id).all()
+    if balances:
+        target.execute(insert(BalanceEntry), [
+            {"bill_list_id": bill_list_id, "participant": participant, "other": other, "amount": amount}
+            for participant, other, amount in balances
+        ])
+    return bill_list.version
+
+def remove_bill_list_copy(db: Session, bill_list_id: int):
+    """Delete every row of a bill list from a shard, whether or not it is soft-deleted."""
+    _delete_bill_list_rows(db, bill_list_id)
+    db.commit()
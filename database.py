@@ -1,19 +1,191 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import logging
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.schema import CreateIndex, CreateTable
+import config
+from config import DATABASE_ASYNC
 from models import Base
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./bill.db"
+logger = logging.getLogger(__name__)
+
+SQLALCHEMY_DATABASE_URL = config.DATABASE_URL
+
+def _pool_options():
+    options = {
+        "pool_size": config.DATABASE_POOL_SIZE,
+        "max_overflow": config.DATABASE_MAX_OVERFLOW,
+        "pool_timeout": config.DATABASE_POOL_TIMEOUT,
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    if config.SQLITE_JOURNAL_MODE:
+        cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+    if config.SQLITE_SYNCHRONOUS:
+        cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+    if config.SQLITE_MMAP_SIZE is not None:
+        cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE:d}")
+    if config.SQLITE_CACHE_SIZE is not None:
+        cursor.execute(f"PRAGMA cache_size={config.SQLITE_CACHE_SIZE:d}")
+    if config.SQLITE_BUSY_TIMEOUT_MS is not None:
+        cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS:d}")
+    if config.SQLITE_FOREIGN_KEYS:
+        cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+def configure_engine(engine):
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+def create_configured_engine(url):
+    return configure_engine(create_engine(url, **_pool_options()))
+
+def create_configured_async_engine(url):
+    from sqlalchemy.ext.asyncio import create_async_engine
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    async_engine = create_async_engine(url.replace("sqlite://", "sqlite+aiosqlite://", 1), **_pool_options())
+    configure_engine(async_engine.sync_engine)
+    return async_engine
+
+engine = create_configured_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-def get_db():
+def get_sync_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
+if DATABASE_ASYNC:
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    async_engine = create_configured_async_engine(SQLALCHEMY_DATABASE_URL)
+    # Objects are serialized after the session call returns, so they must not expire on commit.
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+    async def get_async_db():
+        async with AsyncSessionLocal() as db:
+            yield db
+
+    get_db = get_async_db
+else:
+    get_db = get_sync_db
+
+async def run_db(db, fn, *args, **kwargs):
+    """Call the sync crud function `fn(session, *args, **kwargs)` without blocking the event loop.
+
+    Sync sessions run in the threadpool; async sessions run `fn` on their greenlet-adapted sync session.
+    """
+    if isinstance(db, Session):
+        return await run_in_threadpool(fn, db, *args, **kwargs)
+    return await db.run_sync(fn, *args, **kwargs)
+
+async def release_db(db):
+    """End the session's transaction and return its connection to the pool; the session stays usable.
+
+    Request sessions are closed only after the response is sent, so streaming routes call this to
+    avoid holding a pooled connection for as long as the client stays connected.
+    """
+    if isinstance(db, Session):
+        return await run_in_threadpool(db.close)
+    await db.close()
+
+def begin_transaction(db: Session):
+    """Open the database transaction of the sync session `db` now instead of at its first write.
+
+    pysqlite sends BEGIN only before a data-modifying statement, so until then each read sees its own
+    snapshot, and a SAVEPOINT would open the transaction itself and its RELEASE would commit it.
+    """
+    connection = db.connection()
+    if connection.dialect.name == "sqlite" and not connection.connection.driver_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN")
+
+def upgrade_schema(engine):
+    """Create missing tables, columns and indexes; returns a description of each change made.
+
+    create_all only adds missing tables, so databases created by an earlier version (including the
+    bill.db shipped with the repository) get the columns and indexes added since here.
+    """
+    changes = []
+    Base.metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT '{column.server_default.arg}'"
+                    if not column.nullable:
+                        ddl += " NOT NULL"
+                connection.execute(text(ddl))
+                changes.append(f"added {table.name}.{column.name}")
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(bind=connection)
+                    changes.append(f"added index {index.name}")
+    if engine.dialect.name == "sqlite":
+        for table in Base.metadata.sorted_tables:
+            if table.dialect_options["sqlite"]["autoincrement"] and _rebuild_with_autoincrement(engine, table):
+                changes.append(f"rebuilt {table.name} with AUTOINCREMENT")
+    return changes
+
+def _has_autoincrement(dbapi_connection, table):
+    (sql,) = dbapi_connection.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)).fetchone()
+    return "AUTOINCREMENT" in sql.upper()
+
+def _rebuild_with_autoincrement(engine, table):
+    """Recreate `table` with AUTOINCREMENT, which SQLite only accepts in CREATE TABLE; False if it has it.
+
+    Without it SQLite reuses the id of the newest row once that row is deleted, and cached responses
+    and ETags keyed by bill list id and version would then be served for a different list. Follows
+    the rebuild procedure from SQLite's ALTER TABLE documentation, with foreign keys off so dropping
+    the old table does not cascade into its children.
+    """
+    rebuilt = f"{table.name}_rebuild"
+    create = str(CreateTable(table).compile(dialect=engine.dialect)).replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE {rebuilt} ", 1)
+    columns = ", ".join(column.name for column in table.columns)
+    connection = engine.raw_connection()
+    try:
+        dbapi_connection = connection.driver_connection
+        if _has_autoincrement(dbapi_connection, table):
+            return False
+        isolation_level, dbapi_connection.isolation_level = dbapi_connection.isolation_level, None
+        # foreign_keys cannot be changed inside a transaction.
+        dbapi_connection.execute("PRAGMA foreign_keys=OFF")
+        try:
+            dbapi_connection.execute("BEGIN IMMEDIATE")
+            # Another process may have rebuilt the table while this one waited for the write lock.
+            if _has_autoincrement(dbapi_connection, table):
+                dbapi_connection.execute("ROLLBACK")
+                return False
+            dbapi_connection.execute(create)
+            dbapi_connection.execute(f"INSERT INTO {rebuilt} ({columns}) SELECT {columns} FROM {table.name}")
+            dbapi_connection.execute(f"DROP TABLE {table.name}")
+            dbapi_connection.execute(f"ALTER TABLE {rebuilt} RENAME TO {table.name}")
+            for index in table.indexes:
+                dbapi_connection.execute(str(CreateIndex(index).compile(dialect=engine.dialect)))
+            dbapi_connection.execute("COMMIT")
+        except BaseException:
+            if dbapi_connection.in_transaction:
+                dbapi_connection.execute("ROLLBACK")
+            raise
+        finally:
+            dbapi_connection.execute(f"PRAGMA foreign_keys={'ON' if config.SQLITE_FOREIGN_KEYS else 'OFF'}")
+            dbapi_connection.isolation_level = isolation_level
+        return True
+    finally:
+        connection.close()
+
 # Warning: This will drop all data in the database
 #Base.metadata.drop_all(bind=engine)
-Base.metadata.create_all(bind=engine)
+for change in upgrade_schema(engine):
+    logger.info("schema upgrade: %s", change)
@@ -0,0 +1,34 @@
+import csv
+import io
+
+import crud
+from serialization import dumps
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _encode_ndjson(rows):
+    return b"".join(dumps(dict(zip(crud.TRANSACTION_FIELDS, row))) + b"\n" for row in rows)
+
+
+def _encode_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def iter_transaction_export(session_factory, bill_list_id: int, format: str, batch_size: int):
+    """Yield the encoded export of a bill list's transactions, one chunk per fetched batch.
+
+    The rows come from a session owned by the generator, so it stays open exactly as long as the
+    response is streaming (and is closed if the client disconnects).
+    """
+    encode = _encode_csv if format == "csv" else _encode_ndjson
+    db = session_factory()
+    try:
+        if format == "csv":
+            yield (",".join(crud.TRANSACTION_FIELDS) + "\n").encode()
+        for rows in crud.iter_transaction_rows(db, bill_list_id, batch_size):
+            yield encode(rows)
+    finally:
+        db.close()
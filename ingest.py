@@ -0,0 +1,124 @@
+import csv
+import json
+
+from pydantic import ValidationError
+
+import schemas
+
+CSV_CONTENT_TYPES = {"text/csv", "application/csv"}
+NDJSON_CONTENT_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl"}
+
+
+class BulkFormatError(ValueError):
+    pass
+
+
+def _decode_line(line: bytes, number: int):
+    """The decoded line, or a BulkFormatError to report as that row's error."""
+    try:
+        # utf-8-sig drops the byte order mark that Excel puts at the start of its CSV exports.
+        return line.decode("utf-8-sig" if number == 1 else "utf-8")
+    except UnicodeDecodeError as e:
+        return BulkFormatError(f"Line {number} is not valid UTF-8: {e.reason} at byte {e.start}")
+
+
+async def _iter_lines(request):
+    buffer = b""
+    number = 0
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            number += 1
+            yield _decode_line(line, number)
+    if buffer:
+        yield _decode_line(buffer, number + 1)
+
+
+async def _iter_json_array(request):
+    try:
+        rows = json.loads(await request.body())
+    except ValueError as e:
+        raise BulkFormatError(f"Invalid JSON: {e}")
+    if not isinstance(rows, list):
+        raise BulkFormatError("Expected a JSON array of transactions")
+    for row in rows:
+        yield row
+
+
+async def _iter_ndjson(request):
+    async for line in _iter_lines(request):
+        if isinstance(line, BulkFormatError):
+            yield line
+            continue
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield BulkFormatError(f"Invalid JSON: {e}")
+
+
+async def _iter_csv(request):
+    header = None
+    record = ""
+    async for line in _iter_lines(request):
+        if isinstance(line, BulkFormatError):
+            if header is None:
+                # Nothing has been inserted yet, and without a header no row can be read.
+                raise line
+            # The record the line belonged to cannot be read; drop it and carry on with the next one.
+            record = ""
+            yield line
+            continue
+        # Quoted fields may contain newlines; a record is complete once its quotes balance.
+        record = record + "\n" + line if record else line
+        if record.count('"') % 2:
+            continue
+        fields, record = next(csv.reader([record.rstrip("\r")]), []), ""
+        if not fields:
+            continue
+        if header is None:
+            header = [field.strip() for field in fields]
+        elif len(fields) != len(header):
+            yield BulkFormatError(f"Expected {len(header)} fields, got {len(fields)}")
+        else:
+            yield dict(zip(header, fields))
+    if record:
+        yield BulkFormatError("Unterminated quoted field")
+
+
+def _row_iterator(request):
+    content_type = request.headers.get("content-type", "application/json").split(";")[0].strip().lower()
+    if content_type in CSV_CONTENT_TYPES:
+        return _iter_csv(request)
+    if content_type in NDJSON_CONTENT_TYPES:
+        return _iter_ndjson(request)
+    if content_type == "application/json":
+        return _iter_json_array(request)
+    raise BulkFormatError(f"Unsupported content type: {content_type}")
+
+
+async def iter_transaction_chunks(request, chunk_size: int):
+    """Yield lists of (row index, TransactionCreate or error detail) read from the request body.
+
+    JSON arrays are parsed whole; NDJSON and CSV bodies are parsed line by line as they arrive.
+    """
+    chunk = []
+    index = 0
+    async for row in _row_iterator(request):
+        if isinstance(row, BulkFormatError):
+            chunk.append((index, str(row)))
+        elif not isinstance(row, dict):
+            chunk.append((index, "Expected an object"))
+        else:
+            try:
+                chunk.append((index, schemas.TransactionCreate(**row)))
+            except ValidationError as e:
+                chunk.append((index, schemas.json_safe_errors(e.errors())))
+        index += 1
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
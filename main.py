@@ -1,8 +1,30 @@
-from fastapi import FastAPI, HTTPException, Depends, APIRouter
+from fastapi import FastAPI, HTTPException, Depends, APIRouter, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from database import get_db
+from admission import admission_controller
+from balance_stream import BalanceBroker, iter_balance_events
+from cache import response_cache
+from config import FAST_JSON, GROUP_COMMIT, METRICS, SOFT_DELETE_THRESHOLD
+from database import get_db, release_db, run_db, SessionLocal
+from group_commit import GroupCommitWriter
+from metrics import MetricsMiddleware, metrics
+from purge import BillListPurger
+from serialization import FastJSONResponse
+from sharding import get_bill_list_db
+import balance_engine
 import crud
+import export
+import hashing
+import heapq
+import ingest
+import itertools
 import schemas
+import serialization
+import sharding
+import time
 
 from fastapi import FastAPI, HTTPException, Depends, APIRouter
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
@@ -11,69 +33,314 @@ from sqlalchemy import create_engine, Column, Integer, String, Date, ForeignKey,
 from sqlalchemy.orm import sessionmaker, relationship, Session
 from sqlalchemy.ext.declarative import declarative_base
 from passlib.context import CryptContext
-from typing import List, Optional, Dict
+from typing import List, Literal, Optional, Dict
 from datetime import date
 
 app = FastAPI()
+if METRICS:
+    app.add_middleware(MetricsMiddleware)
+
+transaction_writer = None
+if GROUP_COMMIT:
+    transaction_writer = GroupCommitWriter(SessionLocal)
+    app.add_event_handler("shutdown", transaction_writer.close)
+
+bill_list_purger = BillListPurger(SessionLocal)
+app.add_event_handler("startup", bill_list_purger.resume)
+app.add_event_handler("shutdown", bill_list_purger.close)
+app.add_event_handler("shutdown", hashing.pool.shutdown)
+if METRICS:
+    metrics.add_collector(admission_controller.collect)
+balance_broker = BalanceBroker()
+app.add_event_handler("shutdown", balance_broker.close)
+if sharding.router is not None:
+    app.add_event_handler("startup", sharding.router.resume)
+    app.add_event_handler("shutdown", sharding.router.close)
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    return await request_validation_exception_handler(request, RequestValidationError(schemas.json_safe_errors(exc.errors()), body=exc.body, endpoint_ctx=exc.endpoint_ctx))
+
+def _purger_for(db):
+    shard = db.info.get("shard")
+    return bill_list_purger if shard is None else sharding.router.purgers[shard]
+
+def _writer_for(db):
+    shard = db.info.get("shard")
+    return transaction_writer if shard is None else sharding.router.writers[shard]
+
+def _publish_balance(db, bill_list_id):
+    balance_broker.publish(bill_list_id, sharding.session_factory_for(db))
+
+def _bill_list_id_of(item):
+    return item["id"] if isinstance(item, dict) else item.id
+
+def _etag_matches(if_none_match: Optional[str], etag: str):
+    if not if_none_match:
+        return False
+    return any(tag.strip() in (etag, f"W/{etag}", "*") for tag in if_none_match.split(","))
+
+async def _versioned_response(request: Request, key: tuple, version: int, render):
+    """Serve a GET whose body only changes with the bill list version.
+
+    Answers 304 when the client already holds this version, otherwise serves the cached body or
+    caches the one produced by `render()`.
+    """
+    etag = '"' + "-".join(str(part) for part in key + (version,)) + '"'
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    body = response_cache.get(key + (version,))
+    if body is None:
+        content = await render()
+        body = serialization.dumps(content) if FAST_JSON else JSONResponse(content=jsonable_encoder(content)).body
+        response_cache.put(key + (version,), body)
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 # API routes
-@app.post("/users/", response_model=schemas.UserOut)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    existing_user = crud.get_user_by_username(db, user.username)
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/users/", response_model=schemas.UserOut, dependencies=[Depends(admission_controller.limit("signup"))])
+async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+    existing_user = await run_db(db, crud.get_user_by_username, user.username)
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    return crud.create_user(db, user)
+    started = time.perf_counter()
+    try:
+        hashed_password = await hashing.pool.hash(user.password)
+    except hashing.HashingQueueFull:
+        raise HTTPException(status_code=503, detail="Too many concurrent registrations, try again later", headers={"Retry-After": "1"})
+    metrics.record_hash(time.perf_counter() - started)
+    return await run_db(db, crud.create_user, user, hashed_password)
 
 @app.get("/users/", response_model=List[schemas.UserOut])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return crud.get_users(db, skip, limit)
+async def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    return await run_db(db, crud.get_users, skip, limit)
 
 @app.post("/bill_lists/", response_model=schemas.BillListOut)
-def create_bill_list(bill_list: schemas.BillListCreate, db: Session = Depends(get_db)):
-    return crud.create_bill_list(db, bill_list)
+async def create_bill_list(bill_list: schemas.BillListCreate, db: Session = Depends(get_db)):
+    if sharding.router is None:
+        return await run_db(db, crud.create_bill_list, bill_list)
+    bill_list_id, shard = await run_db(db, crud.register_bill_list, sharding.router.shard_count, sharding.router.bill_list_id_start)
+    async with sharding.router.session(shard) as shard_db:
+        return await run_db(shard_db, crud.create_bill_list, bill_list, bill_list_id)
 
 @app.get("/bill_lists/{bill_list_id}", response_model=schemas.BillListOut)
-def read_bill_list(bill_list_id: int, db: Session = Depends(get_db)):
-    bill_list = crud.get_bill_list(db, bill_list_id)
-    if bill_list is None:
+async def read_bill_list(bill_list_id: int, request: Request, db: Session = Depends(get_bill_list_db)):
+    version = await run_db(db, crud.get_bill_list_version, bill_list_id)
+    if version is None:
         raise HTTPException(status_code=404, detail="Bill list not found")
-    return bill_list
 
-@app.get("/bill_lists/", response_model=List[schemas.BillListOut])
-def read_bill_lists(db: Session = Depends(get_db)):
-    return crud.get_bill_lists(db)
+    async def render():
+        if FAST_JSON:
+            payloads = await run_db(db, crud.get_bill_list_payloads, [bill_list_id])
+            if not payloads:
+                raise HTTPException(status_code=404, detail="Bill list not found")
+            return payloads[0]
+        return schemas.BillListOut.model_validate(await run_db(db, crud.get_bill_list, bill_list_id), from_attributes=True)
+
+    return await _versioned_response(request, ("bill_list", bill_list_id), version, render)
+
+@app.get("/bill_lists/", response_model=List[schemas.BillListPageOut], response_model_exclude_unset=True, dependencies=[Depends(admission_controller.limit("listing"))])
+async def read_bill_lists(
+    response: Response,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[int] = Query(None, description="Id of the last bill list of the previous page"),
+    transactions: Literal["full", "summary", "none"] = Query("full", description="Include transactions, only their count and total, or neither"),
+    db: Session = Depends(get_db),
+):
+    if sharding.router is None:
+        page = await run_db(db, crud.get_bill_list_page, limit, cursor, transactions, FAST_JSON)
+    else:
+        # Every shard returns its own first `limit` lists after the cursor; the merged page is the
+        # first `limit` of those in id order.
+        pages = await sharding.router.map(crud.get_bill_list_page, limit, cursor, transactions, FAST_JSON)
+        page = list(itertools.islice(heapq.merge(*pages, key=_bill_list_id_of), limit))
+    next_cursor = str(_bill_list_id_of(page[-1])) if len(page) == limit else None
+    if FAST_JSON:
+        return FastJSONResponse(page, headers={"X-Next-Cursor": next_cursor} if next_cursor else None)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return page
 
 @app.post("/bill_lists/{bill_list_id}/transactions/", response_model=schemas.TransactionOut)
-def create_transaction_for_bill_list(bill_list_id: int, transaction: schemas.TransactionCreate, db: Session = Depends(get_db)):
+async def create_transaction_for_bill_list(bill_list_id: int, transaction: schemas.TransactionCreate, db: Session = Depends(get_bill_list_db)):
+    if not await run_db(db, crud.bill_list_exists, bill_list_id):
+        raise HTTPException(status_code=404, detail="Bill list not found")
     try:
-        return crud.create_transaction(db, bill_list_id, transaction)
+        writer = _writer_for(db)
+        if writer is not None:
+            created = await writer.create_transaction(bill_list_id, transaction)
+        else:
+            created = await run_db(db, crud.create_transaction, bill_list_id, transaction)
     except ValidationError as e:
         raise HTTPException(status_code=400, detail=e.errors())
+    except crud.UnknownParticipantError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    _publish_balance(db, bill_list_id)
+    return created
 
-@app.get("/bill_lists/{bill_list_id}/balance", response_model=Dict[str, Dict[str, float]])
-def calculate_balance(bill_list_id: int, db: Session = Depends(get_db)):
-    bill_list = crud.get_bill_list(db, bill_list_id)
-    if bill_list is None:
+@app.post("/bill_lists/{bill_list_id}/transactions/bulk", response_model=schemas.BulkTransactionResult, dependencies=[Depends(admission_controller.limit("bulk"))])
+async def create_transactions_bulk(bill_list_id: int, request: Request, chunk_size: int = Query(1000, ge=1, le=10000), db: Session = Depends(get_bill_list_db)):
+    if not await run_db(db, crud.bill_list_exists, bill_list_id):
         raise HTTPException(status_code=404, detail="Bill list not found")
-    return crud.calculate_balance(db, bill_list_id)
+    inserted, errors = 0, []
+    try:
+        async for chunk in ingest.iter_transaction_chunks(request, chunk_size):
+            rows = [(index, row) for index, row in chunk if isinstance(row, schemas.TransactionCreate)]
+            errors.extend({"row": index, "detail": row} for index, row in chunk if not isinstance(row, schemas.TransactionCreate))
+            count, row_errors = await run_db(db, crud.create_transactions_bulk, bill_list_id, [row for _, row in rows])
+            inserted += count
+            errors.extend({"row": rows[position][0], "detail": detail} for position, detail in row_errors)
+    except ingest.BulkFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        # Chunks committed before a format error are kept, so subscribers still need to hear of them.
+        if inserted:
+            _publish_balance(db, bill_list_id)
+    return {"inserted": inserted, "errors": sorted(errors, key=lambda error: error["row"])}
+
+@app.get("/bill_lists/{bill_list_id}/balance", response_model=Dict[str, Dict[str, float]], dependencies=[Depends(admission_controller.limit("balance"))])
+async def calculate_balance(
+    bill_list_id: int,
+    request: Request,
+    sparse: bool = Query(False, description="Omit pairs whose balance is zero"),
+    engine: Literal["ledger", "sql", "python", "numpy", "auto"] = Query("ledger", description="Read the ledger, or recompute from the transaction history with this engine"),
+    db: Session = Depends(get_bill_list_db),
+):
+    version = await run_db(db, crud.get_bill_list_version, bill_list_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Bill list not found")
+
+    async def render():
+        if engine == "ledger":
+            return await run_db(db, crud.calculate_balance, bill_list_id, sparse)
+        try:
+            balance_record = await run_db(db, crud.recalculate_balance, bill_list_id, engine)
+        except balance_engine.EngineUnavailableError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return crud.sparse_balance(balance_record) if sparse else balance_record
+
+    key = ("balance", bill_list_id, engine, "sparse" if sparse else "dense")
+    return await _versioned_response(request, key, version, render)
+
+@app.get("/bill_lists/{bill_list_id}/balance/stream", dependencies=[Depends(admission_controller.limit("streams"))])
+async def stream_balance(
+    bill_list_id: int,
+    sparse: bool = Query(False, description="Omit pairs whose balance is zero"),
+    db: Session = Depends(get_bill_list_db),
+):
+    # Subscribe before reading the current balance so a write in between is not missed.
+    subscription = balance_broker.subscribe(bill_list_id)
+    snapshot = await run_db(db, crud.get_balance_snapshot, bill_list_id)
+    if snapshot is None:
+        balance_broker.unsubscribe(subscription)
+        raise HTTPException(status_code=404, detail="Bill list not found")
+    subscription.put(snapshot)
+    await release_db(db)
+    return StreamingResponse(
+        iter_balance_events(balance_broker, subscription, sparse),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/bill_lists/{bill_list_id}/transactions", response_model=schemas.TransactionPage)
+async def read_transactions(
+    bill_list_id: int,
+    response: Response,
+    payer: Optional[str] = None,
+    participant: Optional[str] = Query(None, description="Only transactions split with this participant"),
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    min_id: Optional[int] = None,
+    max_id: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[int] = Query(None, description="Id of the last transaction of the previous page"),
+    db: Session = Depends(get_bill_list_db),
+):
+    if not await run_db(db, crud.bill_list_exists, bill_list_id):
+        raise HTTPException(status_code=404, detail="Bill list not found")
+    transactions, count, total = await run_db(
+        db, crud.query_transactions, bill_list_id, payer=payer, participant=participant, min_amount=min_amount,
+        max_amount=max_amount, min_id=min_id, max_id=max_id, after_id=cursor, limit=limit, as_dicts=FAST_JSON,
+    )
+    content = {"transactions": transactions, "count": count, "total": total}
+    if FAST_JSON:
+        headers = {"X-Next-Cursor": str(transactions[-1]["id"])} if len(transactions) == limit else None
+        return FastJSONResponse(content, headers=headers)
+    if len(transactions) == limit:
+        response.headers["X-Next-Cursor"] = str(transactions[-1].id)
+    return content
+
+@app.get("/bill_lists/{bill_list_id}/transactions/export", dependencies=[Depends(admission_controller.limit("bulk"))])
+async def export_transactions(
+    bill_list_id: int,
+    format: Literal["ndjson", "csv"] = Query("ndjson"),
+    batch_size: int = Query(1000, ge=1, le=10000, description="Rows fetched from the database per chunk"),
+    db: Session = Depends(get_bill_list_db),
+):
+    if not await run_db(db, crud.bill_list_exists, bill_list_id):
+        raise HTTPException(status_code=404, detail="Bill list not found")
+    await release_db(db)
+    return StreamingResponse(
+        export.iter_transaction_export(sharding.session_factory_for(db), bill_list_id, format, batch_size),
+        media_type=export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="bill_list_{bill_list_id}_transactions.{format}"'},
+    )
+
+@app.get("/bill_lists/{bill_list_id}/settlement", response_model=List[schemas.SettlementTransfer], dependencies=[Depends(admission_controller.limit("balance"))])
+async def read_settlement(bill_list_id: int, db: Session = Depends(get_bill_list_db)):
+    if not await run_db(db, crud.bill_list_exists, bill_list_id):
+        raise HTTPException(status_code=404, detail="Bill list not found")
+    return await run_db(db, crud.calculate_settlement, bill_list_id)
+
+@app.get("/bill_lists/{bill_list_id}/participants/{name}/debts", response_model=Dict[str, float], dependencies=[Depends(admission_controller.limit("balance"))])
+async def read_participant_debts(bill_list_id: int, name: str, db: Session = Depends(get_bill_list_db)):
+    if not await run_db(db, crud.bill_list_exists, bill_list_id):
+        raise HTTPException(status_code=404, detail="Bill list not found")
+    return await run_db(db, crud.get_participant_debts, bill_list_id, name)
 
 @app.delete("/bill_lists/{bill_list_id}/transactions/{transaction_id}", status_code=204)
-def delete_transaction(bill_list_id: int, transaction_id: int, db: Session = Depends(get_db)):
-    if not crud.delete_transaction(db, bill_list_id, transaction_id):
+async def delete_transaction(bill_list_id: int, transaction_id: int, db: Session = Depends(get_bill_list_db)):
+    if not await run_db(db, crud.bill_list_exists, bill_list_id):
+        raise HTTPException(status_code=404, detail="Bill list not found")
+    if not await run_db(db, crud.delete_transaction, bill_list_id, transaction_id):
         raise HTTPException(status_code=404, detail="Transaction not found")
+    _publish_balance(db, bill_list_id)
     return {"detail": "Transaction deleted successfully"}
 
 @app.delete("/bill_lists/{bill_list_id}", status_code=204)
-def delete_bill_list(bill_list_id: int, db: Session = Depends(get_db)):
-    if not crud.delete_bill_list(db, bill_list_id):
+async def delete_bill_list(bill_list_id: int, db: Session = Depends(get_bill_list_db), directory_db: Session = Depends(get_db)):
+    if not await run_db(db, crud.bill_list_exists, bill_list_id):
+        raise HTTPException(status_code=404, detail="Bill list not found")
+    if await run_db(db, crud.count_transactions, bill_list_id) > SOFT_DELETE_THRESHOLD:
+        # Too big to delete within one request: hide it now and purge it in the background.
+        if not await run_db(db, crud.soft_delete_bill_list, bill_list_id):
+            raise HTTPException(status_code=404, detail="Bill list not found")
+        _purger_for(db).submit(bill_list_id)
+        if sharding.router is not None:
+            await run_db(directory_db, crud.unregister_bill_list, bill_list_id)
+        _publish_balance(db, bill_list_id)
+        return Response(status_code=202)
+    if not await run_db(db, crud.delete_bill_list, bill_list_id):
         raise HTTPException(status_code=404, detail="Bill list not found")
+    if sharding.router is not None:
+        await run_db(directory_db, crud.unregister_bill_list, bill_list_id)
+    _publish_balance(db, bill_list_id)
     return {"detail": "Bill list deleted successfully"}
 
 @app.patch("/bill_lists/{bill_list_id}/transactions/{transaction_id}", response_model=schemas.TransactionOut)
-def update_transaction(bill_list_id: int, transaction_id: int, transaction_update: schemas.TransactionUpdate, db: Session = Depends(get_db)):
-    transaction = crud.update_transaction(db, bill_list_id, transaction_id, transaction_update)
+async def update_transaction(bill_list_id: int, transaction_id: int, transaction_update: schemas.TransactionUpdate, db: Session = Depends(get_bill_list_db)):
+    if not await run_db(db, crud.bill_list_exists, bill_list_id):
+        raise HTTPException(status_code=404, detail="Bill list not found")
+    try:
+        transaction = await run_db(db, crud.update_transaction, bill_list_id, transaction_id, transaction_update)
+    except crud.UnknownParticipantError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if transaction is None:
         raise HTTPException(status_code=404, detail="Transaction not found")
+    _publish_balance(db, bill_list_id)
     return transaction
 
 # Add this to your existing FastAPI app instance
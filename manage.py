@@ -0,0 +1,177 @@
+import argparse
+import sys
+
+from database import SessionLocal, engine, upgrade_schema as upgrade_engine_schema
+from models import BillList
+import crud
+import sharding
+
+
+def _bill_list_ids(db, bill_list_id):
+    query = db.query(BillList.id)
+    if bill_list_id is not None:
+        query = query.filter(BillList.id == bill_list_id)
+    return [id_ for (id_,) in query.order_by(BillList.id)]
+
+
+def rebuild_ledger(args):
+    for session_factory in sharding.data_session_factories():
+        db = session_factory()
+        try:
+            for bill_list_id in _bill_list_ids(db, args.bill_list):
+                crud.rebuild_balance_ledger(db, bill_list_id)
+                print(f"bill list {bill_list_id}: ledger rebuilt")
+        finally:
+            db.close()
+    return 0
+
+
+def verify_ledger(args):
+    status = 0
+    for session_factory in sharding.data_session_factories():
+        db = session_factory()
+        try:
+            for bill_list_id in _bill_list_ids(db, args.bill_list):
+                drift = crud.verify_balance_ledger(db, bill_list_id, args.tolerance)
+                for participant, other, ledger_amount, expected_amount in drift:
+                    print(f"bill list {bill_list_id}: {participant} -> {other}: ledger {ledger_amount} != expected {expected_amount}")
+                if drift:
+                    status = 1
+        finally:
+            db.close()
+    if status == 0:
+        print("ledger OK")
+    return status
+
+
+def migrate_splits(args):
+    migrated, skipped = 0, []
+    for session_factory in sharding.data_session_factories():
+        db = session_factory()
+        try:
+            shard_migrated, shard_skipped = crud.migrate_transaction_splits(db, args.batch_size)
+        finally:
+            db.close()
+        migrated += shard_migrated
+        skipped += shard_skipped
+    print(f"migrated {migrated} transactions")
+    for transaction_id in skipped:
+        print(f"transaction {transaction_id}: names a participant missing from its bill list, skipped")
+    return 1 if skipped else 0
+
+
+def upgrade_schema(args):
+    engines = [engine] + (sharding.router.engines if sharding.router is not None else [])
+    for database_engine in engines:
+        for change in upgrade_engine_schema(database_engine):
+            print(change)
+    print("schema up to date")
+    return 0
+
+
+def _require_shards():
+    if sharding.router is None:
+        print("sharding is not enabled; set SHARD_URLS", file=sys.stderr)
+        return False
+    return True
+
+
+def import_bill_lists(args):
+    if not _require_shards():
+        return 2
+    db = SessionLocal()
+    try:
+        bill_list_ids = crud.get_unsharded_bill_list_ids(db)
+    finally:
+        db.close()
+    for bill_list_id in bill_list_ids:
+        shard = sharding.router.import_bill_list(bill_list_id)
+        if shard is not None:
+            print(f"bill list {bill_list_id}: imported into shard {shard}")
+    print(f"imported {len(bill_list_ids)} bill lists")
+    return 0
+
+
+def rebalance_shards(args):
+    if not _require_shards():
+        return 2
+    status = 0
+    for bill_list_id, source, target in sharding.plan_rebalance(sharding.router.bill_list_sizes()):
+        if args.dry_run:
+            print(f"bill list {bill_list_id}: would move from shard {source} to shard {target}")
+            continue
+        try:
+            sharding.router.move_bill_list(bill_list_id, target)
+        except KeyError:
+            # Deleted since the plan was made.
+            print(f"bill list {bill_list_id}: not found; skipped")
+            status = 1
+            continue
+        except sharding.ShardMoveConflict as error:
+            print(f"{error}; skipped")
+            status = 1
+            continue
+        except Exception as error:
+            print(f"bill list {bill_list_id}: move from shard {source} to shard {target} failed: {error!r}; skipped")
+            status = 1
+            continue
+        print(f"bill list {bill_list_id}: moved from shard {source} to shard {target}")
+    return status
+
+
+def move_bill_list(args):
+    if not _require_shards():
+        return 2
+    if not 0 <= args.shard < sharding.router.shard_count:
+        print(f"shard must be between 0 and {sharding.router.shard_count - 1}", file=sys.stderr)
+        return 2
+    try:
+        moved = sharding.router.move_bill_list(args.bill_list, args.shard)
+    except KeyError:
+        print(f"bill list {args.bill_list} not found", file=sys.stderr)
+        return 1
+    except sharding.ShardMoveConflict as error:
+        print(error, file=sys.stderr)
+        return 1
+    print(f"bill list {args.bill_list}: {'moved to' if moved else 'already on'} shard {args.shard}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintenance commands for the bill splitting database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = subparsers.add_parser("rebuild-ledger", help="Recompute the balance ledger from transaction history")
+    rebuild.add_argument("--bill-list", type=int, help="Only rebuild this bill list")
+    rebuild.set_defaults(func=rebuild_ledger)
+
+    verify = subparsers.add_parser("verify-ledger", help="Compare the balance ledger against transaction history")
+    verify.add_argument("--bill-list", type=int, help="Only verify this bill list")
+    verify.add_argument("--tolerance", type=float, default=1e-6, help="Largest difference not reported as drift")
+    verify.set_defaults(func=verify_ledger)
+
+    migrate = subparsers.add_parser("migrate-splits", help="Fill transaction_splits from the split_between strings of existing transactions")
+    migrate.add_argument("--batch-size", type=int, default=1000, help="Transactions migrated per commit")
+    migrate.set_defaults(func=migrate_splits)
+
+    upgrade = subparsers.add_parser("upgrade-schema", help="Add tables and columns introduced since the database was created")
+    upgrade.set_defaults(func=upgrade_schema)
+
+    import_lists = subparsers.add_parser("import-bill-lists", help="Move bill lists created before sharding was enabled into the shards")
+    import_lists.set_defaults(func=import_bill_lists)
+
+    rebalance = subparsers.add_parser("rebalance-shards", help="Move bill lists between shards to even out their transaction counts")
+    rebalance.add_argument("--dry-run", action="store_true", help="Print the planned moves without moving anything")
+    rebalance.set_defaults(func=rebalance_shards)
+
+    move = subparsers.add_parser("move-bill-list", help="Move one bill list to another shard")
+    move.add_argument("bill_list", type=int, help="Bill list id")
+    move.add_argument("shard", type=int, help="Index of the target shard in SHARD_URLS")
+    move.set_defaults(func=move_bill_list)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
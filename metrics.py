@@ -0,0 +1,210 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import N_PLUS_ONE_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds", "hash_seconds", "statements")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.statements = Counter()
+
+
+_current_request = ContextVar("metrics_current_request", default=None)
+
+
+def _format_labels(names, values, extra=""):
+    labels = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    if extra:
+        labels = f"{labels},{extra}" if labels else extra
+    return "{" + labels + "}" if labels else ""
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metrics:
+    """In-process request, database and hashing metrics rendered in the Prometheus text format.
+
+    Per-request counters live in a context variable, which Starlette copies into the threadpool and
+    SQLAlchemy's async greenlets, so the cursor hooks can attribute each query to its request.
+    """
+
+    LABELS = ("method", "route")
+
+    def __init__(self, n_plus_one_threshold: int = N_PLUS_ONE_THRESHOLD):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self._lock = threading.Lock()
+        self._collectors = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = Counter()
+            self.request_seconds = {}
+            self.db_queries = {}
+            self.db_seconds = {}
+            self.n_plus_one = Counter()
+            self.hash_seconds = Histogram(LATENCY_BUCKETS)
+
+    def start_request(self):
+        stats = RequestStats()
+        return stats, _current_request.set(stats)
+
+    def finish_request(self, stats, token, method: str, route: str, status: int, seconds: float):
+        _current_request.reset(token)
+        key = (method, route)
+        repeated = [(statement, count) for statement, count in stats.statements.items() if count >= self.n_plus_one_threshold]
+        with self._lock:
+            self.requests[key + (str(status),)] += 1
+            self._histogram(self.request_seconds, key, LATENCY_BUCKETS).observe(seconds)
+            self._histogram(self.db_queries, key, QUERY_COUNT_BUCKETS).observe(stats.queries)
+            self._histogram(self.db_seconds, key, LATENCY_BUCKETS).observe(stats.db_seconds)
+            if repeated:
+                self.n_plus_one[key] += 1
+        for statement, count in repeated:
+            logger.warning("Possible N+1 query in %s %s: executed %d times: %s", method, route, count, statement)
+
+    @staticmethod
+    def _histogram(histograms, key, buckets):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        return histogram
+
+    def record_query(self, statement: str, seconds: float):
+        stats = _current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += seconds
+            if statement.startswith("SELECT"):
+                stats.statements[statement] += 1
+
+    def record_hash(self, seconds: float):
+        stats = _current_request.get()
+        if stats is not None:
+            stats.hash_seconds += seconds
+        with self._lock:
+            self.hash_seconds.observe(seconds)
+
+    def add_collector(self, collect):
+        """Render `collect()` with every scrape; it returns [(name, type, help, [(labels dict, value), ...])]."""
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, help_text, histograms, label_names=self.LABELS):
+            header(name, "histogram", help_text)
+            for key, hist in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(hist.buckets + (float("inf"),), hist.counts):
+                    cumulative += count
+                    le = 'le="{}"'.format("+Inf" if bound == float("inf") else _format_value(bound))
+                    lines.append(f"{name}_bucket{_format_labels(label_names, key, le)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(label_names, key)} {_format_value(hist.sum)}")
+                lines.append(f"{name}_count{_format_labels(label_names, key)} {hist.count}")
+
+        with self._lock:
+            header("http_requests_total", "counter", "Requests served, by route and status code.")
+            for key, count in sorted(self.requests.items()):
+                lines.append(f"http_requests_total{_format_labels(self.LABELS + ('status',), key)} {count}")
+            histogram("http_request_duration_seconds", "Time from receiving a request to sending the last byte of its response.", self.request_seconds)
+            histogram("db_queries_per_request", "SQL statements executed while serving a request.", self.db_queries)
+            histogram("db_duration_seconds_per_request", "Time spent executing SQL while serving a request.", self.db_seconds)
+            header("db_n_plus_one_requests_total", "counter", f"Requests that ran one SELECT at least {self.n_plus_one_threshold} times.")
+            for key, count in sorted(self.n_plus_one.items()):
+                lines.append(f"db_n_plus_one_requests_total{_format_labels(self.LABELS, key)} {count}")
+            histogram("password_hash_duration_seconds", "Time to hash a password, including waiting for a worker.", {(): self.hash_seconds}, ())
+        for collect in self._collectors:
+            for name, kind, help_text, samples in collect():
+                header(name, kind, help_text)
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics.record_query(statement, time.perf_counter() - conn.info["query_started"])
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request and recording it under its route template.
+
+    Responses also carry a `Server-Timing` header splitting the time spent before the headers were
+    sent into SQL, password hashing and the rest (validation, serialization, waiting).
+    """
+
+    def __init__(self, app, registry: Metrics = metrics):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+        started = time.perf_counter()
+        stats, token = self.registry.start_request()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed = time.perf_counter() - started
+                timing = (
+                    f'db;dur={stats.db_seconds * 1000:.3f};desc="{stats.queries} queries", '
+                    f"hash;dur={stats.hash_seconds * 1000:.3f}, total;dur={elapsed * 1000:.3f}"
+                )
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            # Unmatched paths share one label so arbitrary URLs can't grow the series without bound.
+            path = route.path if route is not None else "unmatched"
+            self.registry.finish_request(stats, token, scope["method"], path, status, time.perf_counter() - started)
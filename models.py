@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Date, ForeignKey, Float
+from sqlalchemy import create_engine, Column, Integer, String, Date, DateTime, ForeignKey, Float, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -15,18 +15,23 @@ class Participant(Base):
     __tablename__ = "participants"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
-    bill_list_id = Column(Integer, ForeignKey("bill_lists.id"))
+    bill_list_id = Column(Integer, ForeignKey("bill_lists.id", ondelete="CASCADE"))
     bill_list = relationship("BillList", back_populates="participants")
 
 class BillList(Base):
     __tablename__ = "bill_lists"
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, index=True)
+    version = Column(Integer, nullable=False, default=1, server_default="1")  # Bumped by every write to the list
+    deleted_at = Column(DateTime, nullable=True)  # Set when the list is hidden pending a background purge
     user_id = Column(Integer, ForeignKey("users.id"))
     owner = relationship("User", back_populates="bill_lists")
-    items = relationship("Item", back_populates="bill_list")
-    participants = relationship("Participant", back_populates="bill_list")
-    transactions = relationship("Transaction", back_populates="bill_list")
+    # The database deletes children with their list, so the ORM must not load them to do it.
+    items = relationship("Item", back_populates="bill_list", passive_deletes=True)
+    participants = relationship("Participant", back_populates="bill_list", passive_deletes=True)
+    transactions = relationship("Transaction", back_populates="bill_list", passive_deletes=True)
+    # Never reuse ids: cached responses and ETags are keyed by (id, version).
+    __table_args__ = {"sqlite_autoincrement": True}
 
 class Item(Base):
     __tablename__ = "items"
@@ -35,7 +40,7 @@ class Item(Base):
     description = Column(String, nullable=True)
     due_date = Column(Date, nullable=True)
     status = Column(String, index=True)
-    bill_list_id = Column(Integer, ForeignKey("bill_lists.id"))
+    bill_list_id = Column(Integer, ForeignKey("bill_lists.id", ondelete="CASCADE"))
     bill_list = relationship("BillList", back_populates="items")
 
 class Transaction(Base):
@@ -45,5 +50,45 @@ class Transaction(Base):
     whatfor = Column(String)
     payer = Column(String)
     split_between = Column(String)
-    bill_list_id = Column(Integer, ForeignKey("bill_lists.id"))
+    bill_list_id = Column(Integer, ForeignKey("bill_lists.id", ondelete="CASCADE"))
     bill_list = relationship("BillList", back_populates="transactions")
+    splits = relationship("TransactionSplit", back_populates="transaction", cascade="all, delete-orphan", passive_deletes=True)
+    __table_args__ = (
+        Index("ix_transactions_bill_list_id", "bill_list_id", "id"),
+        Index("ix_transactions_bill_list_payer", "bill_list_id", "payer"),
+    )
+
+class TransactionSplit(Base):
+    __tablename__ = "transaction_splits"
+    transaction_id = Column(Integer, ForeignKey("transactions.id", ondelete="CASCADE"), primary_key=True)
+    participant_id = Column(Integer, ForeignKey("participants.id", ondelete="CASCADE"), primary_key=True)
+    bill_list_id = Column(Integer, ForeignKey("bill_lists.id", ondelete="CASCADE"))
+    share = Column(Float)  # Portion of the transaction amount owed by the participant
+    transaction = relationship("Transaction", back_populates="splits")
+    __table_args__ = (
+        Index("ix_transaction_splits_bill_list_participant", "bill_list_id", "participant_id"),
+        Index("ix_transaction_splits_participant", "participant_id"),
+    )
+
+class BillListShard(Base):
+    # Shard directory: which database file holds each bill list. Lives in the main database.
+    __tablename__ = "bill_list_shards"
+    bill_list_id = Column(Integer, primary_key=True)
+    shard = Column(Integer, nullable=False, index=True)
+    # Ids handed out here are never reused, even after the list is deleted.
+    __table_args__ = {"sqlite_autoincrement": True}
+
+class IdBlock(Base):
+    # Next unreserved id of each sequence that must be unique across shards.
+    __tablename__ = "id_blocks"
+    name = Column(String, primary_key=True)
+    next_id = Column(Integer, nullable=False)
+
+class BalanceEntry(Base):
+    __tablename__ = "balances"
+    id = Column(Integer, primary_key=True, index=True)
+    bill_list_id = Column(Integer, ForeignKey("bill_lists.id", ondelete="CASCADE"), index=True)
+    participant = Column(String)
+    other = Column(String)
+    amount = Column(Float, default=0.0)  # What `other` owes `participant`; mirrored with the opposite sign
+    __table_args__ = (UniqueConstraint("bill_list_id", "participant", "other"),)
@@ -0,0 +1,77 @@
+import logging
+import queue
+import threading
+import time
+
+import crud
+from config import PURGE_BATCH_SIZE, PURGE_PAUSE_MS
+
+logger = logging.getLogger(__name__)
+
+
+class BillListPurger:
+    """Background thread that deletes soft-deleted bill lists a batch of transactions at a time.
+
+    Every batch is its own short write transaction followed by a pause, so purging a huge list
+    never holds SQLite's write lock for long or ties up a request worker.
+    """
+
+    def __init__(self, session_factory, batch_size: int = PURGE_BATCH_SIZE, pause_ms: int = PURGE_PAUSE_MS):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.pause = pause_ms / 1000
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="bill-list-purger", daemon=True)
+                self._thread.start()
+
+    def submit(self, bill_list_id: int):
+        self._ensure_started()
+        self._jobs.put(bill_list_id)
+
+    def resume(self):
+        """Queue lists that were soft-deleted but not purged before the last shutdown."""
+        db = self.session_factory()
+        try:
+            bill_list_ids = crud.get_soft_deleted_bill_list_ids(db)
+        finally:
+            db.close()
+        for bill_list_id in bill_list_ids:
+            self.submit(bill_list_id)
+
+    def join(self):
+        """Block until every submitted list has been purged."""
+        self._jobs.join()
+
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._jobs.put(None)
+            thread.join()
+
+    def purge(self, bill_list_id: int):
+        db = self.session_factory()
+        try:
+            while crud.purge_bill_list_batch(db, bill_list_id, self.batch_size):
+                time.sleep(self.pause)
+        finally:
+            db.close()
+
+    def _run(self):
+        while True:
+            bill_list_id = self._jobs.get()
+            try:
+                if bill_list_id is None:
+                    return
+                self.purge(bill_list_id)
+            except Exception:
+                # The list stays soft-deleted and is retried by the next resume().
+                logger.exception("Purging bill list %s failed", bill_list_id)
+            finally:
+                self._jobs.task_done()
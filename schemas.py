@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict
+from typing import Any, List, Optional, Dict
 
 class UserBase(BaseModel):
     username: str
@@ -27,6 +27,16 @@ class BillListOut(BillListBase):
     class Config:
         orm_mode = True
 
+class BillListPageOut(BillListBase):
+    id: int
+    participants: List["ParticipantOutNoId"] = []
+    transactions: Optional[List["TransactionOut"]] = None
+    transaction_count: Optional[int] = None
+    transaction_total: Optional[float] = None
+
+    class Config:
+        orm_mode = True
+
 class ParticipantBase(BaseModel):
     name: str
 
@@ -38,7 +48,7 @@ class ParticipantOutNoId(ParticipantBase):
         orm_mode = True
 
 class TransactionBase(BaseModel):
-    amount: float  # Use float for numeric amount
+    amount: float = Field(allow_inf_nan=False)  # Use float for numeric amount
     whatfor: str
     payer: str
     split_between: str
@@ -54,11 +64,33 @@ class TransactionOut(TransactionBase):
         orm_mode = True
 
 class TransactionUpdate(BaseModel):
-    amount: Optional[float] = Field(None, description="The new amount of the transaction")
+    amount: Optional[float] = Field(None, description="The new amount of the transaction", allow_inf_nan=False)
     whatfor: Optional[str] = Field(None, description="Description of what the transaction was for")
     payer: Optional[str] = Field(None, description="Who paid in this transaction")
     split_between: Optional[str] = Field(None, description="How the transaction amount is split among participants")
 
+class TransactionPage(BaseModel):
+    transactions: List[TransactionOut]
+    count: int  # Matching transactions across all pages
+    total: float  # Sum of their amounts
+
+def json_safe_errors(errors):
+    """`ValidationError.errors()` without the non-finite inputs (e.g. `1e400`) that JSON cannot encode."""
+    return [dict(error, input=None) if error["type"] == "finite_number" else error for error in errors]
+
+class BulkRowError(BaseModel):
+    row: int
+    detail: Any
+
+class BulkTransactionResult(BaseModel):
+    inserted: int
+    errors: List[BulkRowError] = []
+
+class SettlementTransfer(BaseModel):
+    payer: str
+    payee: str
+    amount: float
+
 class BalanceRecord(BaseModel):
     balance: Dict[str, Dict[str, float]]
 
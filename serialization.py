@@ -0,0 +1,24 @@
+"""JSON encoding for responses built from plain dicts and lists instead of Pydantic models.
+
+`dumps` produces the same bytes as Starlette's JSONResponse, except that orjson writes floats below
+1e-4 or from 1e16 up without exponent padding or sign (`1e-5` rather than `1e-05`).
+"""
+import json
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the standard library encoder gives identical output, slower.
+    orjson = None
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,263 @@
+"""Spread bill lists over several SQLite databases.
+
+The main database (DATABASE_URL) keeps users and a directory mapping every bill list id to the shard
+holding the list with its participants, transactions, splits and balances. New lists go to shard
+`bill_list_id % len(SHARD_URLS)`; `move_bill_list` and `plan_rebalance` can relocate them later.
+Lists created before sharding was enabled stay in the main database, unseen, until
+`import_bill_list` (`manage.py import-bill-lists`) places them.
+"""
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, HTTPException
+from sqlalchemy.orm import Session, sessionmaker
+
+import crud
+from config import DATABASE_ASYNC, GROUP_COMMIT, SHARD_ID_BLOCK_SIZE, SHARD_URLS
+from database import SessionLocal, begin_transaction, create_configured_async_engine, create_configured_engine, get_db, release_db, run_db, upgrade_schema
+from group_commit import GroupCommitWriter
+from purge import BillListPurger
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShardMoveConflict(RuntimeError):
+    pass
+
+
+class TransactionIdAllocator:
+    """Hands out transaction ids that are unique across shards and processes.
+
+    Ids come from blocks reserved in the main database, so inserts only touch the main database once
+    per `block_size` transactions. Transaction ids are visible to clients and therefore must survive
+    moving a list to another shard.
+    """
+
+    def __init__(self, session_factory, block_size: int = SHARD_ID_BLOCK_SIZE, start: int = 1):
+        self.session_factory = session_factory
+        self.block_size = block_size
+        self.start = start
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, count: int):
+        with self._lock:
+            ids = []
+            while len(ids) < count:
+                if self._next >= self._end:
+                    size = max(self.block_size, count - len(ids))
+                    db = self.session_factory()
+                    try:
+                        self._next = crud.reserve_id_block(db, "transactions", size, self.start)
+                    finally:
+                        db.close()
+                    self._end = self._next + size
+                take = min(count - len(ids), self._end - self._next)
+                ids.extend(range(self._next, self._next + take))
+                self._next += take
+            return ids
+
+
+class ShardRouter:
+    def __init__(self, shard_urls, directory_session_factory=SessionLocal, block_size: int = SHARD_ID_BLOCK_SIZE):
+        self.directory_session_factory = directory_session_factory
+        self.engines = [create_configured_engine(url) for url in shard_urls]
+        for engine in self.engines:
+            upgrade_schema(engine)
+        # Ids continue above those already used anywhere, including lists not imported into a shard yet.
+        shard_sessions = [Session(bind=engine) for engine in self.engines]
+        directory = directory_session_factory()
+        try:
+            databases = [directory] + shard_sessions
+            self.bill_list_id_start = 1 + max(crud.get_max_bill_list_id(db) for db in databases)
+            transaction_id_start = 1 + max(crud.get_max_transaction_id(db) for db in databases)
+            unsharded = len(crud.get_unsharded_bill_list_ids(directory))
+        finally:
+            for db in [directory] + shard_sessions:
+                db.close()
+        if unsharded:
+            logger.warning("%d bill lists in DATABASE_URL are in no shard and cannot be reached; run `python manage.py import-bill-lists`", unsharded)
+        self.allocator = TransactionIdAllocator(directory_session_factory, block_size, transaction_id_start)
+
+        def session_info(shard):
+            return {"shard": shard, "reserve_transaction_ids": self.allocator.reserve}
+
+        self.session_factories = [
+            sessionmaker(autocommit=False, autoflush=False, bind=engine, info=session_info(shard)) for shard, engine in enumerate(self.engines)
+        ]
+        self.async_session_factories = None
+        if DATABASE_ASYNC:
+            from sqlalchemy.ext.asyncio import async_sessionmaker
+
+            self.async_engines = [create_configured_async_engine(url) for url in shard_urls]
+            self.async_session_factories = [
+                async_sessionmaker(engine, autoflush=False, expire_on_commit=False, info=session_info(shard))
+                for shard, engine in enumerate(self.async_engines)
+            ]
+        # Background work is per database file, like the single-database writer and purger in main.
+        self.purgers = [BillListPurger(factory) for factory in self.session_factories]
+        self.writers = [GroupCommitWriter(factory) if GROUP_COMMIT else None for factory in self.session_factories]
+
+    @property
+    def shard_count(self):
+        return len(self.engines)
+
+    @asynccontextmanager
+    async def session(self, shard: int):
+        if self.async_session_factories is not None:
+            async with self.async_session_factories[shard]() as db:
+                yield db
+        else:
+            db = self.session_factories[shard]()
+            try:
+                yield db
+            finally:
+                db.close()
+
+    async def map(self, fn, *args, **kwargs):
+        """Run the crud function `fn(session, *args, **kwargs)` on every shard concurrently."""
+
+        async def run(shard):
+            async with self.session(shard) as db:
+                return await run_db(db, fn, *args, **kwargs)
+
+        return await asyncio.gather(*(run(shard) for shard in range(self.shard_count)))
+
+    def move_bill_list(self, bill_list_id: int, target: int):
+        """Copy a bill list to shard `target`, repoint the directory at it and delete the old copy.
+
+        Returns False if the list already lives there. Raises ShardMoveConflict, leaving the list
+        where it was, if the list was written to while it was being copied. If the new copy was also
+        written to before the directory was pointed back, neither copy is deleted and the error says
+        so: the two must then be reconciled by hand.
+        """
+        directory = self.directory_session_factory()
+        source_db = target_db = None
+        try:
+            source = crud.get_bill_list_shard(directory, bill_list_id)
+            if source is None:
+                raise KeyError(f"Bill list {bill_list_id} is not in the shard directory")
+            if source == target:
+                return False
+            source_db, target_db = self.session_factories[source](), self.session_factories[target]()
+            # The copy reads one snapshot of the source, so it is consistent even while writes continue.
+            begin_transaction(source_db)
+            version = crud.copy_bill_list(source_db, target_db, bill_list_id)
+            target_db.commit()
+            source_db.rollback()
+            crud.set_bill_list_shard(directory, bill_list_id, target)
+            # Writes committed to the source after the snapshot would be lost with the old copy.
+            if crud.get_bill_list_version(source_db, bill_list_id, include_deleted=True) != version:
+                crud.set_bill_list_shard(directory, bill_list_id, source)
+                # Requests routed to the new copy between the two directory updates may have written to it.
+                if crud.get_bill_list_version(target_db, bill_list_id, include_deleted=True) != version:
+                    raise ShardMoveConflict(
+                        f"Bill list {bill_list_id} was written to on both shard {source} and shard {target} while it was being moved; "
+                        f"the directory points at shard {source} again and both copies were kept"
+                    )
+                crud.remove_bill_list_copy(target_db, bill_list_id)
+                raise ShardMoveConflict(f"Bill list {bill_list_id} changed while it was being moved")
+            crud.remove_bill_list_copy(source_db, bill_list_id)
+            return True
+        finally:
+            for db in (directory, source_db, target_db):
+                if db is not None:
+                    db.close()
+
+    def import_bill_list(self, bill_list_id: int):
+        """Move a list created before sharding was enabled from the main database to shard `id % N`.
+
+        Such lists are unreachable while sharding is on, so nothing writes to them during the copy.
+        Returns the shard, or None if the list is already in the directory.
+        """
+        directory = self.directory_session_factory()
+        source_db = target_db = None
+        try:
+            if crud.get_bill_list_shard(directory, bill_list_id) is not None:
+                return None
+            target = bill_list_id % self.shard_count
+            source_db, target_db = self.directory_session_factory(), self.session_factories[target]()
+            begin_transaction(source_db)
+            crud.copy_bill_list(source_db, target_db, bill_list_id)
+            target_db.commit()
+            source_db.rollback()
+            crud.set_bill_list_shard(directory, bill_list_id, target)
+            crud.remove_bill_list_copy(source_db, bill_list_id)
+            return target
+        finally:
+            for db in (directory, source_db, target_db):
+                if db is not None:
+                    db.close()
+
+    def bill_list_sizes(self):
+        """{shard: {bill_list_id: transaction count}} for every shard."""
+        sizes = {}
+        for shard, factory in enumerate(self.session_factories):
+            db = factory()
+            try:
+                sizes[shard] = crud.get_bill_list_sizes(db)
+            finally:
+                db.close()
+        return sizes
+
+    def resume(self):
+        for purger in self.purgers:
+            purger.resume()
+
+    def close(self):
+        for worker in self.purgers + [writer for writer in self.writers if writer is not None]:
+            worker.close()
+
+
+def plan_rebalance(sizes):
+    """Greedy list moves [(bill_list_id, source, target)] evening out transactions per shard.
+
+    `sizes` maps each shard to {bill_list_id: transaction count}. Each move takes the list from the
+    heaviest shard that best halves its gap to the lightest one, until no move narrows the gap.
+    """
+    sizes = {shard: dict(lists) for shard, lists in sizes.items()}
+    loads = {shard: sum(lists.values()) for shard, lists in sizes.items()}
+    moves = []
+    while len(loads) > 1:
+        heavy, light = max(loads, key=loads.get), min(loads, key=loads.get)
+        gap = loads[heavy] - loads[light]
+        # Moving a list of size s leaves a gap of |gap - 2s|, which is smaller only when 0 < s < gap.
+        candidates = [(bill_list_id, size) for bill_list_id, size in sizes[heavy].items() if 0 < size < gap]
+        if not candidates:
+            break
+        bill_list_id, size = min(candidates, key=lambda candidate: (abs(gap - 2 * candidate[1]), candidate[0]))
+        sizes[light][bill_list_id] = sizes[heavy].pop(bill_list_id)
+        loads[heavy] -= size
+        loads[light] += size
+        moves.append((bill_list_id, heavy, light))
+    return moves
+
+
+router = ShardRouter(SHARD_URLS) if SHARD_URLS else None
+
+
+async def get_bill_list_db(bill_list_id: int, db: Session = Depends(get_db)):
+    """Session on the database holding `bill_list_id`: the request's own session unless sharding is on."""
+    if router is None:
+        yield db
+        return
+    shard = await run_db(db, crud.get_bill_list_shard, bill_list_id)
+    if shard is None:
+        raise HTTPException(status_code=404, detail="Bill list not found")
+    await release_db(db)
+    async with router.session(shard) as shard_db:
+        yield shard_db
+
+
+def session_factory_for(db):
+    """Sync session factory for the database `db` belongs to, for work that outlives the request."""
+    shard = db.info.get("shard")
+    return SessionLocal if shard is None else router.session_factories[shard]
+
+
+def data_session_factories():
+    """Session factories of every database holding bill lists."""
+    return router.session_factories if router is not None else [SessionLocal]
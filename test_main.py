@@ -1,12 +1,47 @@
+import argparse
+import asyncio
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
 import unittest
+from unittest import mock
+
+# Keep the test run away from the development database.
+os.environ.setdefault("DATABASE_URL", "sqlite:///./test_bill.db")
+
+from fastapi.responses import JSONResponse
 from fastapi.testclient import TestClient
+import main
 from main import app
+import schemas
+import database
 from database import get_db, engine, SessionLocal
-from models import Base
+from models import Base, BalanceEntry, BillList, Participant, Transaction, TransactionSplit
+import balance_engine
+import crud
+import hashing
+import manage
+from group_commit import GroupCommitWriter
+from purge import BillListPurger
+from admission import AdmissionRejected, RouteGroupLimiter, admission_controller
+from balance_stream import BalanceSubscription
+from cache import ResponseCache, response_cache
+from metrics import Metrics, metrics
+import serialization
+import sharding
+from benchmarks.balance_engines import synthetic_splits
+from models import User
 from fastapi import FastAPI, HTTPException, Depends, APIRouter
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, Field, ValidationError
 from sqlalchemy import create_engine, Column, Integer, String, Date, ForeignKey,Float
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker, relationship, Session
 from sqlalchemy.ext.declarative import declarative_base
 from passlib.context import CryptContext
@@ -21,12 +56,24 @@ Base.metadata.drop_all(bind=engine)
 Base.metadata.create_all(bind=engine)
 
 # Dependency override for testing
-def override_get_db():
-    db = TestingSessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+if database.DATABASE_ASYNC:
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    query_engine = database.async_engine.sync_engine
+    TestingAsyncSessionLocal = async_sessionmaker(database.async_engine, autoflush=False, expire_on_commit=False)
+
+    async def override_get_db():
+        async with TestingAsyncSessionLocal() as db:
+            yield db
+else:
+    query_engine = engine
+
+    def override_get_db():
+        db = TestingSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
 
 app.dependency_overrides[get_db] = override_get_db
 
@@ -38,6 +85,9 @@ class TestAPI(unittest.TestCase):
         # Initialize the test database
         self.db = TestingSessionLocal()
         Base.metadata.create_all(bind=engine)
+        # Ids and versions restart with the schema, so responses cached by earlier tests would be stale.
+        response_cache.clear()
+        metrics.reset()
     
     def tearDown(self):
         # Drop the test database
@@ -56,6 +106,27 @@ class TestAPI(unittest.TestCase):
         response = client.post("/users/", json={"username": "testuser", "password": "newpassword"})
         self.assertEqual(response.status_code, 400)
 
+    def test_create_user_hashes_password(self):
+        client.post("/users/", json={"username": "testuser", "password": "testpassword"})
+        user = self.db.query(User).filter(User.username == "testuser").first()
+        self.assertNotEqual(user.password_hash, "testpassword")
+        self.assertTrue(hashing.verify_password("testpassword", user.password_hash))
+
+    def test_create_user_hashing_queue_full(self):
+        pool = hashing.HashingPool(workers=1, queue_size=0)
+        pool._slots.acquire()
+        original_pool, hashing.pool = hashing.pool, pool
+        try:
+            response = client.post("/users/", json={"username": "testuser", "password": "testpassword"})
+        finally:
+            hashing.pool = original_pool
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response.headers)
+        self.assertEqual(client.get("/users/").json(), [])
+
+    def test_hashing_pool_shut_down_with_app(self):
+        self.assertIn(hashing.pool.shutdown, app.router.on_shutdown)
+
     def test_read_users(self):
         client.post("/users/", json={"username": "testuser1", "password": "testpassword"})
         client.post("/users/", json={"username": "testuser2", "password": "testpassword"})
@@ -90,6 +161,54 @@ class TestAPI(unittest.TestCase):
         response = client.get("/bill_lists/9999")
         self.assertEqual(response.status_code, 404)
 
+    def test_read_bill_lists_paginated(self):
+        ids = [client.post("/bill_lists/", json={"title": f"list {i}", "participants": [{"name": "participant1"}]}).json()["id"] for i in range(5)]
+        response = client.get("/bill_lists/?limit=2")
+        self.assertEqual([bill_list["id"] for bill_list in response.json()], ids[:2])
+        response = client.get(f"/bill_lists/?limit=2&cursor={response.headers['X-Next-Cursor']}")
+        self.assertEqual([bill_list["id"] for bill_list in response.json()], ids[2:4])
+        response = client.get(f"/bill_lists/?limit=2&cursor={response.headers['X-Next-Cursor']}")
+        self.assertEqual([bill_list["id"] for bill_list in response.json()], ids[4:])
+        self.assertNotIn("X-Next-Cursor", response.headers)
+
+    def test_read_bill_lists_transaction_modes(self):
+        bill_list_id = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}]}).json()["id"]
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 100.0, "whatfor": "a", "payer": "participant1", "split_between": "participant1"})
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 50.0, "whatfor": "b", "payer": "participant1", "split_between": "participant1"})
+        full = client.get("/bill_lists/").json()[0]
+        self.assertEqual(len(full["transactions"]), 2)
+        self.assertNotIn("transaction_count", full)
+        summary = client.get("/bill_lists/?transactions=summary").json()[0]
+        self.assertNotIn("transactions", summary)
+        self.assertEqual((summary["transaction_count"], summary["transaction_total"]), (2, 150.0))
+        self.assertEqual(summary["participants"], [{"name": "participant1"}])
+        none = client.get("/bill_lists/?transactions=none").json()[0]
+        self.assertEqual(set(none), {"id", "title", "participants"})
+
+    def test_read_bill_lists_constant_query_count(self):
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        def queries_for_page(mode):
+            statements.clear()
+            event.listen(query_engine, "before_cursor_execute", count)
+            try:
+                client.get(f"/bill_lists/?transactions={mode}")
+            finally:
+                event.remove(query_engine, "before_cursor_execute", count)
+            return len(statements)
+
+        for i in range(2):
+            bill_list_id = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]}).json()["id"]
+            client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 10.0, "whatfor": "a", "payer": "participant1", "split_between": "participant2"})
+        small = {mode: queries_for_page(mode) for mode in ("full", "summary", "none")}
+        for i in range(8):
+            bill_list_id = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]}).json()["id"]
+            client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 10.0, "whatfor": "a", "payer": "participant1", "split_between": "participant2"})
+        large = {mode: queries_for_page(mode) for mode in ("full", "summary", "none")}
+        self.assertEqual(small, large)
+
     def test_create_transaction_for_bill_list(self):
         bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}]})
         bill_list_id = bill_list_response.json()["id"]
@@ -125,6 +244,532 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(response.json()["participant1"]["participant2"], 0.0)
         self.assertEqual(response.json()["participant2"]["participant1"], 0.0)
 
+    def test_balance_follows_transaction_updates_and_deletes(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        transaction_response = client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 100.0, "whatfor": "test transaction", "payer": "participant1", "split_between": "participant1, participant2"})
+        transaction_id = transaction_response.json()["id"]
+        client.patch(f"/bill_lists/{bill_list_id}/transactions/{transaction_id}", json={"payer": "participant2", "amount": 60.0})
+        response = client.get(f"/bill_lists/{bill_list_id}/balance")
+        self.assertEqual(response.json()["participant1"]["participant2"], -30.0)
+        self.assertEqual(response.json()["participant2"]["participant1"], 30.0)
+        client.delete(f"/bill_lists/{bill_list_id}/transactions/{transaction_id}")
+        response = client.get(f"/bill_lists/{bill_list_id}/balance")
+        self.assertEqual(response.json()["participant1"]["participant2"], 0.0)
+        self.assertEqual(response.json()["participant2"]["participant1"], 0.0)
+
+    def test_verify_and_rebuild_balance_ledger(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}, {"name": "participant3"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 90.0, "whatfor": "test transaction", "payer": "participant1", "split_between": "participant1, participant2, participant3"})
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 20.0, "whatfor": "test transaction", "payer": "participant3", "split_between": "participant2"})
+        self.assertEqual(crud.verify_balance_ledger(self.db, bill_list_id), [])
+        self.assertEqual(crud.calculate_balance(self.db, bill_list_id), crud.recalculate_balance(self.db, bill_list_id))
+
+        self.db.query(BalanceEntry).filter(BalanceEntry.bill_list_id == bill_list_id).update({"amount": BalanceEntry.amount + 1})
+        self.db.commit()
+        self.assertNotEqual(crud.verify_balance_ledger(self.db, bill_list_id), [])
+        crud.rebuild_balance_ledger(self.db, bill_list_id)
+        self.assertEqual(crud.verify_balance_ledger(self.db, bill_list_id), [])
+
+    def test_create_transaction_with_unknown_participant(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 100.0, "whatfor": "test transaction", "payer": "participant1", "split_between": "participant1, stranger"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_read_participant_debts(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}, {"name": "participant3"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 90.0, "whatfor": "test transaction", "payer": "participant1", "split_between": "participant1, participant2, participant3"})
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 20.0, "whatfor": "test transaction", "payer": "participant2", "split_between": "participant1"})
+        response = client.get(f"/bill_lists/{bill_list_id}/participants/participant2/debts")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"participant1": 10.0})
+
+    def test_migrate_transaction_splits(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        self.db.add(Transaction(amount=100.0, whatfor="legacy", payer="participant1", split_between="participant1, participant2", bill_list_id=bill_list_id))
+        self.db.add(Transaction(amount=10.0, whatfor="legacy", payer="participant1", split_between="stranger", bill_list_id=bill_list_id))
+        self.db.commit()
+        migrated, skipped = crud.migrate_transaction_splits(self.db)
+        self.assertEqual(migrated, 1)
+        self.assertEqual(len(skipped), 1)
+        shares = sorted(share for (share,) in self.db.query(TransactionSplit.share).filter(TransactionSplit.bill_list_id == bill_list_id))
+        self.assertEqual(shares, [50.0, 50.0])
+        self.assertEqual(crud.recalculate_balance(self.db, bill_list_id)["participant1"]["participant2"], 50.0)
+
+    def test_bulk_create_transactions_json(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        rows = [
+            {"amount": 100.0, "whatfor": "dinner", "payer": "participant1", "split_between": "participant1, participant2"},
+            {"amount": "invalid", "whatfor": "bad amount", "payer": "participant1", "split_between": "participant2"},
+            {"amount": 10.0, "whatfor": "taxi", "payer": "participant2", "split_between": "stranger"},
+            {"amount": 20.0, "whatfor": "coffee", "payer": "participant2", "split_between": "participant1"},
+        ]
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/bulk?chunk_size=2", json=rows)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["inserted"], 2)
+        self.assertEqual([error["row"] for error in response.json()["errors"]], [1, 2])
+        self.assertEqual(len(client.get(f"/bill_lists/{bill_list_id}").json()["transactions"]), 2)
+        self.assertEqual(client.get(f"/bill_lists/{bill_list_id}/balance").json()["participant1"]["participant2"], 30.0)
+        self.assertEqual(crud.verify_balance_ledger(self.db, bill_list_id), [])
+
+    def test_bulk_create_transactions_ndjson_and_csv(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        ndjson = '{"amount": 10.0, "whatfor": "a", "payer": "participant1", "split_between": "participant2"}\nnot json\n'
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/bulk", content=ndjson, headers={"Content-Type": "application/x-ndjson"})
+        self.assertEqual(response.json()["inserted"], 1)
+        self.assertEqual([error["row"] for error in response.json()["errors"]], [1])
+        csv_body = 'amount,whatfor,payer,split_between\n20.0,"lunch,\nwith drinks",participant1,"participant1, participant2"\n'
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/bulk", content=csv_body, headers={"Content-Type": "text/csv"})
+        self.assertEqual(response.json(), {"inserted": 1, "errors": []})
+        transactions = client.get(f"/bill_lists/{bill_list_id}").json()["transactions"]
+        self.assertEqual(transactions[-1]["whatfor"], "lunch,\nwith drinks")
+        self.assertEqual(client.get(f"/bill_lists/{bill_list_id}/balance").json()["participant1"]["participant2"], 20.0)
+
+    def test_bulk_create_transactions_encoding(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        csv_body = "\ufeffamount,whatfor,payer,split_between\n20.0,caf\u00e9,participant1,participant2\n".encode("utf-8")
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/bulk", content=csv_body, headers={"Content-Type": "text/csv"})
+        self.assertEqual(response.json(), {"inserted": 1, "errors": []})
+        # An undecodable row is reported like any other bad row, and the rows around it are kept.
+        latin1_body = "amount,whatfor,payer,split_between\n1.0,tea,participant1,participant2\n20.0,caf\u00e9,participant1,participant2\n2.0,tea,participant1,participant2\n".encode("latin-1")
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/bulk?chunk_size=1", content=latin1_body, headers={"Content-Type": "text/csv"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["inserted"], 2)
+        self.assertEqual([error["row"] for error in response.json()["errors"]], [1])
+        self.assertIn("Line 3 is not valid UTF-8", response.json()["errors"][0]["detail"])
+        ndjson = b'{"amount": 1.0, "whatfor": "tea", "payer": "participant1", "split_between": "participant2"}\n{"whatfor": "caf\xe9"}\n'
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/bulk", content=ndjson, headers={"Content-Type": "application/x-ndjson"})
+        self.assertEqual((response.json()["inserted"], [error["row"] for error in response.json()["errors"]]), (1, [1]))
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/bulk", content="caf\u00e9\n".encode("latin-1"), headers={"Content-Type": "text/csv"})
+        self.assertEqual(response.status_code, 400)
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/bulk", content=b'[{"whatfor": "caf\xe9"}]', headers={"Content-Type": "application/json"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_non_finite_amounts_are_rejected(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        body = '{"amount": 1e400, "whatfor": "overflow", "payer": "participant1", "split_between": "participant2"}'
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/", content=body, headers={"Content-Type": "application/json"})
+        self.assertEqual(response.status_code, 422)
+        ndjson = body + '\n{"amount": NaN, "whatfor": "nan", "payer": "participant1", "split_between": "participant2"}\n'
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/bulk", content=ndjson, headers={"Content-Type": "application/x-ndjson"})
+        self.assertEqual((response.json()["inserted"], [error["row"] for error in response.json()["errors"]]), (0, [0, 1]))
+        csv_body = "amount,whatfor,payer,split_between\ninf,overflow,participant1,participant2\n"
+        response = client.post(f"/bill_lists/{bill_list_id}/transactions/bulk", content=csv_body, headers={"Content-Type": "text/csv"})
+        self.assertEqual((response.json()["inserted"], [error["row"] for error in response.json()["errors"]]), (0, [0]))
+        transaction_id = client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 10.0, "whatfor": "tea", "payer": "participant1", "split_between": "participant2"}).json()["id"]
+        response = client.patch(f"/bill_lists/{bill_list_id}/transactions/{transaction_id}", content='{"amount": -1e400}', headers={"Content-Type": "application/json"})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(client.get(f"/bill_lists/{bill_list_id}/balance").json()["participant1"]["participant2"], 10.0)
+
+    def test_bulk_create_transactions_non_existent_bill_list(self):
+        response = client.post("/bill_lists/9999/transactions/bulk", json=[])
+        self.assertEqual(response.status_code, 404)
+
+    def test_calculate_balance_sparse(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}, {"name": "participant3"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 100.0, "whatfor": "test transaction", "payer": "participant1", "split_between": "participant1, participant2"})
+        response = client.get(f"/bill_lists/{bill_list_id}/balance?sparse=true")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"participant1": {"participant2": 50.0}, "participant2": {"participant1": -50.0}})
+
+    def test_settlement(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}, {"name": "participant3"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 30.0, "whatfor": "a", "payer": "participant1", "split_between": "participant2"})
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 30.0, "whatfor": "b", "payer": "participant2", "split_between": "participant3"})
+        response = client.get(f"/bill_lists/{bill_list_id}/settlement")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [{"payer": "participant3", "payee": "participant1", "amount": 30.0}])
+        self.assertEqual(client.get("/bill_lists/9999/settlement").status_code, 404)
+
+    def test_settle_debts_clears_all_positions(self):
+        rng = random.Random(7)
+        for _ in range(20):
+            names = [f"p{i}" for i in range(rng.randint(2, 30))]
+            positions = {name: round(rng.uniform(-100, 100), 2) for name in names[:-1]}
+            positions[names[-1]] = -sum(positions.values())
+            transfers = crud.settle_debts(positions)
+            self.assertLessEqual(len(transfers), len(names) - 1)
+            remaining = dict(positions)
+            for transfer in transfers:
+                self.assertGreater(transfer["amount"], 0)
+                remaining[transfer["payer"]] += transfer["amount"]
+                remaining[transfer["payee"]] -= transfer["amount"]
+            for amount in remaining.values():
+                self.assertAlmostEqual(amount, 0.0, places=6)
+
+    def test_numpy_engine_matches_python_engine(self):
+        names, payers, splitters, shares = synthetic_splits(participants=30, transactions=2000, seed=3)
+        payers.append("former participant")
+        splitters.append("participant0")
+        shares.append(12.5)
+        expected = balance_engine.compute_balance_python(names, payers, splitters, shares)
+        actual = balance_engine.compute_balance_numpy(names, payers, splitters, shares)
+        self.assertEqual(list(actual), list(expected))
+        for participant, row in expected.items():
+            self.assertEqual(list(actual[participant]), list(row))
+            for other, amount in row.items():
+                self.assertAlmostEqual(actual[participant][other], amount, places=6)
+        # No transactions, or only payers' own shares: every amount must still be a float.
+        for payers, splitters, shares in (([], [], []), (["participant0"], ["participant0"], [10.0])):
+            expected = balance_engine.compute_balance_python(["participant0", "participant1"], payers, splitters, shares)
+            actual = balance_engine.compute_balance_numpy(["participant0", "participant1"], payers, splitters, shares)
+            self.assertEqual(actual, expected)
+            self.assertEqual({type(amount) for row in actual.values() for amount in row.values()}, {float})
+
+    def test_calculate_balance_engines_agree(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}, {"name": "participant3"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 90.0, "whatfor": "a", "payer": "participant1", "split_between": "participant1, participant2, participant3"})
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 20.0, "whatfor": "b", "payer": "participant3", "split_between": "participant2"})
+        ledger = client.get(f"/bill_lists/{bill_list_id}/balance").json()
+        for engine in ("sql", "python", "numpy", "auto"):
+            response = client.get(f"/bill_lists/{bill_list_id}/balance?engine={engine}")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), ledger)
+
+    def test_upgrade_schema_upgrades_old_bill_lists_table(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        old_engine = database.create_configured_engine(f"sqlite:///{directory}/old.db")
+        self.addCleanup(old_engine.dispose)
+        with old_engine.begin() as connection:
+            # bill_lists as created before versions, soft deletes and AUTOINCREMENT existed.
+            connection.exec_driver_sql("CREATE TABLE bill_lists (id INTEGER NOT NULL, title VARCHAR, user_id INTEGER, PRIMARY KEY (id))")
+            connection.exec_driver_sql(
+                "CREATE TABLE participants (id INTEGER NOT NULL, name VARCHAR, bill_list_id INTEGER, PRIMARY KEY (id), "
+                "FOREIGN KEY(bill_list_id) REFERENCES bill_lists (id) ON DELETE CASCADE)"
+            )
+            connection.exec_driver_sql("INSERT INTO bill_lists (id, title) VALUES (1, 'old list'), (2, 'newest list')")
+            connection.exec_driver_sql("INSERT INTO participants (name, bill_list_id) VALUES ('participant1', 1)")
+        changes = database.upgrade_schema(old_engine)
+        self.assertIn("added bill_lists.version", changes)
+        self.assertIn("added bill_lists.deleted_at", changes)
+        self.assertIn("rebuilt bill_lists with AUTOINCREMENT", changes)
+        self.assertEqual(database.upgrade_schema(old_engine), [])
+        db = Session(bind=old_engine)
+        try:
+            self.assertEqual(crud.get_bill_list_version(db, 1), 1)
+            self.assertEqual([participant.name for participant in crud.get_bill_list(db, 1).participants], ["participant1"])
+            # The id of a deleted newest list must not be handed out again.
+            self.assertTrue(crud.delete_bill_list(db, 2))
+            self.assertEqual(crud.create_bill_list(db, schemas.BillListCreate(title="new list", participants=[])).id, 3)
+        finally:
+            db.close()
+
+    def test_bill_list_etag(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        for path in (f"/bill_lists/{bill_list_id}", f"/bill_lists/{bill_list_id}/balance"):
+            response = client.get(path)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers["ETag"]
+            cached = client.get(path, headers={"If-None-Match": etag})
+            self.assertEqual(cached.status_code, 304)
+            self.assertEqual(cached.headers["ETag"], etag)
+
+        first = client.get(f"/bill_lists/{bill_list_id}/balance")
+        client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 100.0, "whatfor": "test transaction", "payer": "participant1", "split_between": "participant1, participant2"})
+        for path in (f"/bill_lists/{bill_list_id}", f"/bill_lists/{bill_list_id}/balance"):
+            response = client.get(path, headers={"If-None-Match": first.headers["ETag"]})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["participant1"]["participant2"], 50.0)
+        self.assertNotEqual(response.headers["ETag"], first.headers["ETag"])
+        sparse = client.get(f"/bill_lists/{bill_list_id}/balance?sparse=true")
+        self.assertNotEqual(sparse.headers["ETag"], response.headers["ETag"])
+
+    def test_response_cache_evicts_least_recently_used(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.put("a", b"1234")
+        cache.put("b", b"1234")
+        cache.get("a")
+        cache.put("c", b"1234")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), b"1234")
+        self.assertEqual(cache.get("c"), b"1234")
+        self.assertEqual(cache.size, 8)
+        cache.put("too big", b"12345678901")
+        self.assertEqual(len(cache), 2)
+
+    def test_query_transactions(self):
+        bill_list_id = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}, {"name": "participant3"}]}).json()["id"]
+        rows = [
+            (10.0, "participant1", "participant1, participant2"),
+            (20.0, "participant2", "participant2, participant3"),
+            (30.0, "participant1", "participant3"),
+            (40.0, "participant3", "participant1, participant3"),
+            (50.0, "participant1", "participant1, participant2, participant3"),
+        ]
+        for amount, payer, split_between in rows:
+            client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": amount, "whatfor": "test transaction", "payer": payer, "split_between": split_between})
+
+        response = client.get(f"/bill_lists/{bill_list_id}/transactions?payer=participant1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([t["amount"] for t in response.json()["transactions"]], [10.0, 30.0, 50.0])
+        self.assertEqual((response.json()["count"], response.json()["total"]), (3, 90.0))
+
+        response = client.get(f"/bill_lists/{bill_list_id}/transactions?participant=participant2&min_amount=15")
+        self.assertEqual([t["amount"] for t in response.json()["transactions"]], [20.0, 50.0])
+
+        ids = [t["id"] for t in client.get(f"/bill_lists/{bill_list_id}/transactions").json()["transactions"]]
+        response = client.get(f"/bill_lists/{bill_list_id}/transactions?min_id={ids[1]}&max_id={ids[3]}&max_amount=35")
+        self.assertEqual([t["amount"] for t in response.json()["transactions"]], [20.0, 30.0])
+
+        response = client.get(f"/bill_lists/{bill_list_id}/transactions?min_amount=15&limit=2")
+        self.assertEqual([t["amount"] for t in response.json()["transactions"]], [20.0, 30.0])
+        self.assertEqual((response.json()["count"], response.json()["total"]), (4, 140.0))
+        response = client.get(f"/bill_lists/{bill_list_id}/transactions?min_amount=15&limit=2&cursor={response.headers['X-Next-Cursor']}")
+        self.assertEqual([t["amount"] for t in response.json()["transactions"]], [40.0, 50.0])
+        response = client.get(f"/bill_lists/{bill_list_id}/transactions?min_amount=15&limit=2&cursor={response.headers['X-Next-Cursor']}")
+        self.assertEqual(response.json()["transactions"], [])
+        self.assertNotIn("X-Next-Cursor", response.headers)
+
+        response = client.get(f"/bill_lists/{bill_list_id}/transactions?payer=nobody")
+        self.assertEqual(response.json(), {"transactions": [], "count": 0, "total": 0.0})
+        self.assertEqual(client.get("/bill_lists/9999/transactions").status_code, 404)
+
+    def test_query_transactions_uses_indexes(self):
+        with engine.connect() as connection:
+            plan = " ".join(row[-1] for row in connection.exec_driver_sql(
+                "EXPLAIN QUERY PLAN SELECT id FROM transactions WHERE bill_list_id = 1 AND payer = 'participant1' ORDER BY id"
+            ))
+            self.assertIn("ix_transactions_bill_list_payer", plan)
+            plan = " ".join(row[-1] for row in connection.exec_driver_sql(
+                "EXPLAIN QUERY PLAN SELECT id FROM transactions WHERE bill_list_id = 1 AND id > 10 ORDER BY id LIMIT 100"
+            ))
+            self.assertIn("ix_transactions_bill_list_id", plan)
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_fast_json_matches_pydantic_output(self):
+        for title in ("first list", "Café ☕"):
+            bill_list_id = client.post("/bill_lists/", json={"title": title, "participants": [{"name": "participant1"}, {"name": "Zoë"}]}).json()["id"]
+            for amount, whatfor in ((100 / 3, "dinner"), (0.1 + 0.2, "crème brûlée"), (12.0, 'quote " and \\ backslash')):
+                client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": amount, "whatfor": whatfor, "payer": "participant1", "split_between": "participant1, Zoë"})
+        client.post("/bill_lists/", json={"title": "empty list"})
+        paths = [
+            "/bill_lists/1", "/bill_lists/3",
+            "/bill_lists/?limit=2", "/bill_lists/?limit=2&cursor=2", "/bill_lists/?transactions=summary", "/bill_lists/?transactions=none",
+            "/bill_lists/1/transactions", "/bill_lists/2/transactions?limit=2&min_amount=1", "/bill_lists/1/transactions?payer=nobody",
+            "/bill_lists/1/balance", "/bill_lists/2/balance?sparse=true",
+        ]
+        for path in paths:
+            responses = []
+            for fast in (True, False):
+                response_cache.clear()
+                with mock.patch.object(main, "FAST_JSON", fast):
+                    responses.append(client.get(path))
+            fast_response, pydantic_response = responses
+            self.assertEqual(fast_response.status_code, 200, path)
+            self.assertEqual(fast_response.content, pydantic_response.content, path)
+            self.assertEqual(fast_response.headers.get("X-Next-Cursor"), pydantic_response.headers.get("X-Next-Cursor"), path)
+
+    def test_serialization_dumps_matches_json_response(self):
+        content = {"a": [1, 2.5, 100 / 3, None, True], "ü": "☕ \"quoted\"\n", "nested": {"x": -0.0, "y": 123456789.125}}
+        expected = JSONResponse(content=content).body
+        self.assertEqual(serialization.dumps(content), expected)
+        with mock.patch.object(serialization, "orjson", None):
+            self.assertEqual(serialization.dumps(content), expected)
+
+    def test_export_transactions(self):
+        bill_list_id = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]}).json()["id"]
+        for i in range(5):
+            client.post(f"/bill_lists/{bill_list_id}/transactions/", json={"amount": 10.0 + i, "whatfor": f"item, {i}", "payer": "participant1", "split_between": "participant1, participant2"})
+        expected = client.get(f"/bill_lists/{bill_list_id}").json()["transactions"]
+
+        response = client.get(f"/bill_lists/{bill_list_id}/transactions/export?batch_size=2")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("application/x-ndjson"))
+        self.assertEqual([json.loads(line) for line in response.text.splitlines()], expected)
+
+        response = client.get(f"/bill_lists/{bill_list_id}/transactions/export?format=csv&batch_size=2")
+        self.assertTrue(response.headers["content-type"].startswith("text/csv"))
+        rows = list(csv.DictReader(response.text.splitlines()))
+        self.assertEqual([row["whatfor"] for row in rows], [transaction["whatfor"] for transaction in expected])
+        self.assertEqual([float(row["amount"]) for row in rows], [transaction["amount"] for transaction in expected])
+
+    def test_export_transactions_non_existent_bill_list(self):
+        response = client.get("/bill_lists/9999/transactions/export")
+        self.assertEqual(response.status_code, 404)
+
+    def test_stream_balance(self):
+        bill_list_id = self._create_bill_list_with_transactions(1)
+        transaction = schemas.TransactionCreate(amount=10.0, whatfor="test transaction", payer="participant1", split_between="participant1, participant2")
+        broker = main.balance_broker
+
+        def parse(event):
+            fields = dict(line.split(": ", 1) for line in event.decode().strip().split("\n"))
+            return fields.get("id"), fields["event"], json.loads(fields["data"])
+
+        async def scenario():
+            response = await main.stream_balance(bill_list_id, sparse=True, db=TestingSessionLocal())
+            events = response.body_iterator
+            received = [parse(await events.__anext__())]
+            coalesced = broker.coalesced
+            for _ in range(3):
+                crud.create_transaction(self.db, bill_list_id, transaction)
+                broker.publish(bill_list_id, TestingSessionLocal)
+            received.append(parse(await asyncio.wait_for(events.__anext__(), 5)))
+            self.assertEqual(broker.coalesced - coalesced, 2)
+            crud.delete_bill_list(self.db, bill_list_id)
+            broker.publish(bill_list_id, TestingSessionLocal)
+            received.append(parse(await asyncio.wait_for(events.__anext__(), 5)))
+            with self.assertRaises(StopAsyncIteration):
+                await events.__anext__()
+            return received
+
+        first, update, deleted = asyncio.run(scenario())
+        self.assertEqual(first[1:], ("balance", {"participant1": {"participant2": 5.0}, "participant2": {"participant1": -5.0}}))
+        self.assertEqual(int(update[0]), int(first[0]) + 3)
+        self.assertEqual(update[2]["participant2"], {"participant1": -20.0})
+        self.assertEqual(deleted, (None, "deleted", {}))
+        self.assertEqual(broker.subscriber_count(bill_list_id), 0)
+
+    def test_stream_balance_non_existent_bill_list(self):
+        response = client.get("/bill_lists/9999/balance/stream")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(main.balance_broker.subscriber_count(), 0)
+
+    def test_balance_subscription_drops_oldest_snapshots(self):
+        subscription = BalanceSubscription(1, buffer_size=2)
+        for version in (1, 2, 3, 2):
+            subscription.put((version, {}))
+        self.assertEqual(subscription.dropped, 1)
+
+        async def drain():
+            return [await subscription.get(1) for _ in range(2)]
+
+        self.assertEqual(asyncio.run(drain()), [(2, {}), (3, {})])
+
+    def test_metrics_endpoint(self):
+        bill_list_id = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}]}).json()["id"]
+        response = client.get(f"/bill_lists/{bill_list_id}")
+        self.assertIn("db;dur=", response.headers["Server-Timing"])
+        self.assertNotIn('desc="0 queries"', response.headers["Server-Timing"])
+        client.get("/no/such/path")
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+        text = response.text
+        self.assertIn('http_requests_total{method="GET",route="/bill_lists/{bill_list_id}",status="200"} 1', text)
+        self.assertIn('http_requests_total{method="GET",route="unmatched",status="404"} 1', text)
+        self.assertIn('http_request_duration_seconds_count{method="POST",route="/bill_lists/"} 1', text)
+        self.assertIn('db_queries_per_request_bucket{method="GET",route="/bill_lists/{bill_list_id}",le="+Inf"} 1', text)
+        self.assertNotIn("db_n_plus_one_requests_total{", text)
+
+    def test_metrics_flags_repeated_queries(self):
+        client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}]})
+        registry = Metrics(n_plus_one_threshold=3)
+        stats, token = registry.start_request()
+        for _ in range(3):
+            # Lazy loads, as a response model touching an unloaded relationship would trigger.
+            self.db.expire_all()
+            self.db.query(BillList).first().participants
+        registry.finish_request(stats, token, "GET", "/bill_lists/", 200, 0.01)
+        self.assertGreaterEqual(stats.queries, 6)
+        self.assertGreater(stats.db_seconds, 0)
+        self.assertIn('db_n_plus_one_requests_total{method="GET",route="/bill_lists/"} 1', registry.render())
+
+    def test_admission_sheds_when_queue_full(self):
+        bill_list_id = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}]}).json()["id"]
+        limiter = RouteGroupLimiter("listing", max_concurrency=1, max_queue=0, max_wait_ms=0)
+        with mock.patch.dict(admission_controller.limiters, {"listing": limiter}):
+            self.assertEqual(client.get("/bill_lists/").status_code, 200)
+            self.assertEqual((limiter.active, limiter.admitted), (0, 1))
+            limiter.active = 1
+            response = client.get("/bill_lists/")
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers["Retry-After"], "1")
+            # Routes outside the group are not held up.
+            self.assertEqual(client.get(f"/bill_lists/{bill_list_id}").status_code, 200)
+            self.assertIn('admission_shed_total{group="listing",reason="queue_full"} 1', client.get("/metrics").text)
+
+    def test_route_group_limiter_queues_then_sheds(self):
+        limiter = RouteGroupLimiter("test", max_concurrency=1, max_queue=1, max_wait_ms=50)
+
+        async def scenario():
+            await limiter.acquire()
+            waiting = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0)
+            self.assertEqual(limiter.queued, 1)
+            with self.assertRaises(AdmissionRejected) as rejected:
+                await limiter.acquire()
+            self.assertEqual(rejected.exception.status_code, 429)
+            limiter.release(0.01)
+            await waiting
+            self.assertEqual((limiter.active, limiter.queued), (1, 0))
+            with self.assertRaises(AdmissionRejected) as rejected:
+                await limiter.acquire()
+            self.assertEqual(rejected.exception.status_code, 503)
+            limiter.release(0.01)
+
+        asyncio.run(scenario())
+        self.assertEqual((limiter.active, limiter.queued, limiter.admitted), (0, 0, 2))
+        self.assertEqual(limiter.shed, {"queue_full": 1, "timeout": 1})
+
+    def test_group_commit_writer(self):
+        bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]})
+        bill_list_id = bill_list_response.json()["id"]
+        writer = GroupCommitWriter(TestingSessionLocal, max_batch=64, max_wait_ms=20)
+        transaction = schemas.TransactionCreate(amount=10.0, whatfor="test transaction", payer="participant1", split_between="participant2")
+        futures = []
+        def submit():
+            futures.append(writer.submit(bill_list_id, transaction))
+        threads = [threading.Thread(target=submit) for _ in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        invalid = writer.submit(bill_list_id, schemas.TransactionCreate(amount=10.0, whatfor="test transaction", payer="stranger", split_between="participant2"))
+        results = [future.result(timeout=10) for future in futures]
+        with self.assertRaises(crud.UnknownParticipantError):
+            invalid.result(timeout=10)
+        writer.close()
+
+        self.assertEqual(len({result.id for result in results}), 40)
+        self.assertLess(writer.batches, 40)
+        self.assertEqual(client.get(f"/bill_lists/{bill_list_id}/balance").json()["participant1"]["participant2"], 400.0)
+        self.assertEqual(crud.verify_balance_ledger(self.db, bill_list_id), [])
+
+    def test_group_commit_writer_isolates_failing_bill_list(self):
+        bill_list_ids = [
+            client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]}).json()["id"]
+            for _ in range(2)
+        ]
+        insert_transactions = crud.insert_transactions
+        def failing_insert(db, bill_list_id, transactions):
+            result = insert_transactions(db, bill_list_id, transactions)
+            if bill_list_id == bill_list_ids[1]:
+                raise RuntimeError("insert failed")
+            return result
+        writer = GroupCommitWriter(TestingSessionLocal, max_batch=64, max_wait_ms=200)
+        transaction = schemas.TransactionCreate(amount=10.0, whatfor="test transaction", payer="participant1", split_between="participant2")
+        with mock.patch.object(crud, "insert_transactions", failing_insert):
+            futures = [(bill_list_id, writer.submit(bill_list_id, transaction)) for _ in range(3) for bill_list_id in bill_list_ids]
+            for bill_list_id, future in futures:
+                if bill_list_id == bill_list_ids[1]:
+                    with self.assertRaises(RuntimeError):
+                        future.result(timeout=10)
+                else:
+                    future.result(timeout=10)
+        writer.close()
+
+        self.assertEqual(writer.batches, 1)
+        balances = [client.get(f"/bill_lists/{bill_list_id}/balance").json() for bill_list_id in bill_list_ids]
+        self.assertEqual(balances[0]["participant1"]["participant2"], 30.0)
+        self.assertEqual(balances[1]["participant1"]["participant2"], 0)
+        self.assertEqual(self.db.query(Transaction).filter(Transaction.bill_list_id == bill_list_ids[1]).count(), 0)
+        for bill_list_id in bill_list_ids:
+            self.assertEqual(crud.verify_balance_ledger(self.db, bill_list_id), [])
+
     def test_delete_transaction(self):
         bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}]})
         bill_list_id = bill_list_response.json()["id"]
@@ -149,6 +794,63 @@ class TestAPI(unittest.TestCase):
         response = client.delete("/bill_lists/9999")
         self.assertEqual(response.status_code, 404)
 
+    def _create_bill_list_with_transactions(self, count):
+        bill_list_id = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]}).json()["id"]
+        body = [{"amount": 10.0, "whatfor": "test transaction", "payer": "participant1", "split_between": "participant1, participant2"}] * count
+        client.post(f"/bill_lists/{bill_list_id}/transactions/bulk", json=body)
+        return bill_list_id
+
+    def _bill_list_row_counts(self, bill_list_id):
+        self.db.expire_all()
+        return {
+            model.__tablename__: self.db.query(model).filter(model.bill_list_id == bill_list_id).count()
+            for model in (BalanceEntry, TransactionSplit, Transaction, Participant)
+        }
+
+    def test_delete_bill_list_removes_children(self):
+        bill_list_id = self._create_bill_list_with_transactions(3)
+        other_id = self._create_bill_list_with_transactions(2)
+        response = client.delete(f"/bill_lists/{bill_list_id}")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(set(self._bill_list_row_counts(bill_list_id).values()), {0})
+        self.assertEqual(self._bill_list_row_counts(other_id)["transactions"], 2)
+
+    def test_bill_list_foreign_keys_cascade(self):
+        bill_list_id = self._create_bill_list_with_transactions(3)
+        with engine.begin() as connection:
+            connection.exec_driver_sql("DELETE FROM bill_lists WHERE id = ?", (bill_list_id,))
+        self.assertEqual(set(self._bill_list_row_counts(bill_list_id).values()), {0})
+
+    def test_soft_delete_large_bill_list(self):
+        bill_list_id = self._create_bill_list_with_transactions(5)
+        other_id = self._create_bill_list_with_transactions(1)
+        with mock.patch.object(main, "SOFT_DELETE_THRESHOLD", 2), mock.patch.object(main.bill_list_purger, "submit") as submit:
+            response = client.delete(f"/bill_lists/{bill_list_id}")
+        self.assertEqual(response.status_code, 202)
+        submit.assert_called_once_with(bill_list_id)
+
+        self.assertEqual(client.get(f"/bill_lists/{bill_list_id}").status_code, 404)
+        self.assertEqual(client.get(f"/bill_lists/{bill_list_id}/balance").status_code, 404)
+        self.assertEqual([bill_list["id"] for bill_list in client.get("/bill_lists/").json()], [other_id])
+        transaction = {"amount": 10.0, "whatfor": "test transaction", "payer": "participant1", "split_between": "participant2"}
+        self.assertEqual(client.post(f"/bill_lists/{bill_list_id}/transactions/", json=transaction).status_code, 404)
+        self.assertEqual(client.delete(f"/bill_lists/{bill_list_id}").status_code, 404)
+
+        purger = BillListPurger(TestingSessionLocal, batch_size=2, pause_ms=0)
+        purger.resume()
+        purger.join()
+        purger.close()
+        self.assertEqual(set(self._bill_list_row_counts(bill_list_id).values()), {0})
+        self.assertIsNone(self.db.get(BillList, bill_list_id))
+        self.assertEqual(self._bill_list_row_counts(other_id)["transactions"], 1)
+
+    def test_purge_bill_list_batches(self):
+        bill_list_id = self._create_bill_list_with_transactions(5)
+        self.assertTrue(crud.soft_delete_bill_list(self.db, bill_list_id))
+        self.assertEqual(crud.get_soft_deleted_bill_list_ids(self.db), [bill_list_id])
+        self.assertEqual([crud.purge_bill_list_batch(self.db, bill_list_id, 2) for _ in range(4)], [2, 2, 1, 0])
+        self.assertEqual(crud.get_soft_deleted_bill_list_ids(self.db), [])
+
     def test_update_transaction(self):
         bill_list_response = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}]})
         bill_list_id = bill_list_response.json()["id"]
@@ -165,5 +867,209 @@ class TestAPI(unittest.TestCase):
         update_response = client.patch(f"/bill_lists/{bill_list_id}/transactions/9999", json={"amount": 150.0, "whatfor": "updated transaction"})
         self.assertEqual(update_response.status_code, 404)
 
+class TestSharding(unittest.TestCase):
+
+    def setUp(self):
+        Base.metadata.create_all(bind=engine)
+        response_cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.urls = [f"sqlite:///{self.directory}/shard{shard}.db" for shard in range(2)]
+        self.router = self._start_router()
+        patcher = mock.patch.object(sharding, "router", self.router)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _start_router(self):
+        router = sharding.ShardRouter(self.urls, directory_session_factory=TestingSessionLocal, block_size=3)
+        self.routers = getattr(self, "routers", []) + [router]
+        return router
+
+    def tearDown(self):
+        for router in self.routers:
+            router.close()
+            for shard_engine in router.engines:
+                shard_engine.dispose()
+        shutil.rmtree(self.directory)
+        Base.metadata.drop_all(bind=engine)
+
+    def _create_bill_list(self, transactions=0):
+        bill_list_id = client.post("/bill_lists/", json={"title": "test bill list", "participants": [{"name": "participant1"}, {"name": "participant2"}]}).json()["id"]
+        body = [{"amount": 10.0, "whatfor": "test transaction", "payer": "participant1", "split_between": "participant1, participant2"}] * transactions
+        if body:
+            client.post(f"/bill_lists/{bill_list_id}/transactions/bulk", json=body)
+        return bill_list_id
+
+    def _shard_bill_list_ids(self, shard):
+        db = self.router.session_factories[shard]()
+        try:
+            return [id_ for (id_,) in db.query(BillList.id).order_by(BillList.id)]
+        finally:
+            db.close()
+
+    def test_bill_lists_are_placed_by_id(self):
+        bill_list_ids = [self._create_bill_list(transactions=2) for _ in range(4)]
+        for shard in range(2):
+            self.assertEqual(self._shard_bill_list_ids(shard), [id_ for id_ in bill_list_ids if id_ % 2 == shard])
+        bill_list = client.get(f"/bill_lists/{bill_list_ids[1]}").json()
+        self.assertEqual(len(bill_list["transactions"]), 2)
+        self.assertEqual(client.get(f"/bill_lists/{bill_list_ids[1]}/balance").json()["participant2"]["participant1"], -10.0)
+        transaction = {"amount": 5.0, "whatfor": "test transaction", "payer": "participant2", "split_between": "participant1"}
+        self.assertEqual(client.post(f"/bill_lists/{bill_list_ids[0]}/transactions/", json=transaction).status_code, 200)
+        transaction_ids = [transaction["id"] for id_ in bill_list_ids for transaction in client.get(f"/bill_lists/{id_}").json()["transactions"]]
+        self.assertEqual(len(set(transaction_ids)), 9)
+
+    def test_list_bill_lists_merges_shards(self):
+        bill_list_ids = [self._create_bill_list() for _ in range(5)]
+        seen, cursor = [], None
+        while True:
+            params = {"limit": 2, "transactions": "summary"}
+            if cursor is not None:
+                params["cursor"] = cursor
+            response = client.get("/bill_lists/", params=params)
+            seen += [bill_list["id"] for bill_list in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+        self.assertEqual(seen, bill_list_ids)
+
+    def test_delete_bill_list_unregisters_it(self):
+        bill_list_id = self._create_bill_list(transactions=1)
+        self.assertEqual(client.delete(f"/bill_lists/{bill_list_id}").status_code, 204)
+        db = TestingSessionLocal()
+        try:
+            self.assertIsNone(crud.get_bill_list_shard(db, bill_list_id))
+        finally:
+            db.close()
+        self.assertEqual(client.get(f"/bill_lists/{bill_list_id}").status_code, 404)
+
+    def test_move_bill_list(self):
+        bill_list_id = self._create_bill_list(transactions=3)
+        before = client.get(f"/bill_lists/{bill_list_id}").json()
+        source, target = bill_list_id % 2, 1 - bill_list_id % 2
+        self.assertTrue(self.router.move_bill_list(bill_list_id, target))
+        self.assertFalse(self.router.move_bill_list(bill_list_id, target))
+        self.assertEqual(self._shard_bill_list_ids(source), [])
+        self.assertEqual(self._shard_bill_list_ids(target), [bill_list_id])
+        response_cache.clear()
+        self.assertEqual(client.get(f"/bill_lists/{bill_list_id}").json(), before)
+        self.assertEqual(client.get(f"/bill_lists/{bill_list_id}/balance").json()["participant2"]["participant1"], -15.0)
+
+    def _bump_version(self, shard, bill_list_id):
+        db = self.router.session_factories[shard]()
+        try:
+            crud.bump_bill_list_version(db, bill_list_id)
+            db.commit()
+        finally:
+            db.close()
+
+    def test_move_bill_list_conflicts(self):
+        bill_list_id = self._create_bill_list(transactions=1)
+        source, target = bill_list_id % 2, 1 - bill_list_id % 2
+        set_bill_list_shard = crud.set_bill_list_shard
+
+        def write_during_move(shards):
+            def set_shard(db, bill_list_id, shard):
+                set_bill_list_shard(db, bill_list_id, shard)
+                if shard == target:
+                    for written in shards:
+                        self._bump_version(written, bill_list_id)
+            return set_shard
+
+        # Written only on the source: the new copy is discarded.
+        with mock.patch.object(crud, "set_bill_list_shard", write_during_move([source])):
+            with self.assertRaisesRegex(sharding.ShardMoveConflict, "changed while it was being moved"):
+                self.router.move_bill_list(bill_list_id, target)
+        self.assertEqual(self._shard_bill_list_ids(target), [])
+
+        # Written on both copies: neither is deleted.
+        with mock.patch.object(crud, "set_bill_list_shard", write_during_move([source, target])):
+            with self.assertRaisesRegex(sharding.ShardMoveConflict, "both copies were kept"):
+                self.router.move_bill_list(bill_list_id, target)
+        self.assertEqual(self._shard_bill_list_ids(source), [bill_list_id])
+        self.assertEqual(self._shard_bill_list_ids(target), [bill_list_id])
+        db = TestingSessionLocal()
+        try:
+            self.assertEqual(crud.get_bill_list_shard(db, bill_list_id), source)
+        finally:
+            db.close()
+
+    def test_move_bill_list_copies_one_snapshot(self):
+        bill_list_id = self._create_bill_list(transactions=2)
+        target = 1 - bill_list_id % 2
+        iter_transaction_rows = crud.iter_transaction_rows
+        body = {"amount": 5.0, "whatfor": "test transaction", "payer": "participant2", "split_between": "participant1"}
+
+        def write_during_copy(db, bill_list_id):
+            # Between copying the transactions and their splits.
+            yield from iter_transaction_rows(db, bill_list_id)
+            self.assertEqual(client.post(f"/bill_lists/{bill_list_id}/transactions/", json=body).status_code, 200)
+
+        with mock.patch.object(crud, "iter_transaction_rows", write_during_copy):
+            with self.assertRaisesRegex(sharding.ShardMoveConflict, "changed while it was being moved"):
+                self.router.move_bill_list(bill_list_id, target)
+        self.assertEqual(self._shard_bill_list_ids(target), [])
+        self.assertEqual(len(client.get(f"/bill_lists/{bill_list_id}").json()["transactions"]), 3)
+
+    def test_rebalance_skips_failed_moves(self):
+        deleted_id, failing_id, moved_id = [self._create_bill_list(transactions=1) for _ in range(3)]
+        self.assertEqual(client.delete(f"/bill_lists/{deleted_id}").status_code, 204)
+        for sizes in self.router.bill_list_sizes().values():
+            self.assertNotIn(deleted_id, sizes)
+        move_bill_list = self.router.move_bill_list
+
+        def failing_move(bill_list_id, target):
+            if bill_list_id == failing_id:
+                raise RuntimeError("database is locked")
+            return move_bill_list(bill_list_id, target)
+
+        moves = [(id_, id_ % 2, 1 - id_ % 2) for id_ in (deleted_id, failing_id, moved_id)]
+        output = io.StringIO()
+        with mock.patch.object(sharding, "plan_rebalance", return_value=moves), mock.patch.object(self.router, "move_bill_list", failing_move):
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(manage.rebalance_shards(argparse.Namespace(dry_run=False)), 1)
+        self.assertIn(f"bill list {deleted_id}: not found; skipped", output.getvalue())
+        self.assertIn(f"bill list {failing_id}: move from shard", output.getvalue())
+        self.assertIn(moved_id, self._shard_bill_list_ids(1 - moved_id % 2))
+        self.assertNotIn(moved_id, self._shard_bill_list_ids(moved_id % 2))
+
+    def test_import_existing_bill_lists(self):
+        db = TestingSessionLocal()
+        try:
+            bill_list = crud.create_bill_list(db, schemas.BillListCreate(title="old list", participants=[{"name": "participant1"}, {"name": "participant2"}]))
+            old_id = bill_list.id
+            transaction = schemas.TransactionCreate(amount=10.0, whatfor="test transaction", payer="participant1", split_between="participant2")
+            transaction_id = crud.create_transaction(db, old_id, transaction).id
+        finally:
+            db.close()
+        with self.assertLogs("sharding", "WARNING"):
+            router = self._start_router()
+        with mock.patch.object(sharding, "router", router):
+            self.assertEqual(client.get(f"/bill_lists/{old_id}").status_code, 404)
+            new_id = self._create_bill_list()
+            self.assertGreater(new_id, old_id)
+            self.assertEqual(router.import_bill_list(old_id), old_id % 2)
+            self.assertIsNone(router.import_bill_list(old_id))
+            bill_list = client.get(f"/bill_lists/{old_id}").json()
+            self.assertEqual((bill_list["title"], [t["id"] for t in bill_list["transactions"]]), ("old list", [transaction_id]))
+            body = {"amount": 5.0, "whatfor": "test transaction", "payer": "participant2", "split_between": "participant1"}
+            self.assertGreater(client.post(f"/bill_lists/{old_id}/transactions/", json=body).json()["id"], transaction_id)
+        db = TestingSessionLocal()
+        try:
+            self.assertEqual(db.query(BillList).count(), 0)
+        finally:
+            db.close()
+
+    def test_plan_rebalance(self):
+        sizes = {0: {1: 30, 3: 20, 5: 10, 7: 5}, 1: {2: 5}, 2: {}}
+        moves = sharding.plan_rebalance(sizes)
+        self.assertEqual(moves, [(1, 0, 2), (3, 0, 1)])
+        self.assertEqual(sharding.plan_rebalance({0: {1: 100}, 1: {}}), [])
+
+    def test_transaction_id_allocator(self):
+        allocators = [sharding.TransactionIdAllocator(TestingSessionLocal, block_size=4, start=10) for _ in range(2)]
+        ids = allocators[0].reserve(3) + allocators[1].reserve(2) + allocators[0].reserve(6)
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(min(ids), 10)
+
 if __name__ == "__main__":
     unittest.main()